@@ -1,3 +1,10 @@
 # annotator/__init__.py
 
-from .app import AnnotationApp
\ No newline at end of file
+# AnnotationApp 依赖 ipywidgets/IPython，按需导入，使批处理等无界面入口不必加载它们
+def __getattr__(name):
+    if name == 'AnnotationApp':
+        from .app import AnnotationApp
+        return AnnotationApp
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+__all__ = ['AnnotationApp']
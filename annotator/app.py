@@ -1,19 +1,54 @@
 # annotator/app.py
 
 import pandas as pd
+import numpy as np
 import ipywidgets as widgets
 from IPython.display import display, clear_output
 from ipyfilechooser import FileChooser
 import os
-from .image_processing import process_cell_type_map
+import io
+import sys
+import asyncio
+import threading
+import contextlib
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from .image_processing import process_cell_type_map, GenerationCancelled, PIPELINE_STAGES
+from .cache import StageCache
+from .profiling import Profiler
+from .io import guess_column_names, placeholder_coordinates, load_annotations, spot_barcodes, match_barcodes, read_csv_chunked
 from .editor import CellTypeAnnotator
 import matplotlib.pyplot as plt
 
+# 进度条中各阶段的显示名称
+STAGE_LABELS = {'coords': '读取坐标文件', 'annotations': '读取标注文件', 'tile_colors': '提取网格代表色', 'clustering': '颜色聚类', 'correction': '邻里校正', 'merge': '合并 Barcode'}
+
+class _OutputStream(io.TextIOBase):
+    """
+    临时替换 sys.stdout：创建它的线程写入的内容以 append_stdout 追加到 Output 控件 (可跨线程、可在按钮回调返回后调用)，
+    其他线程的输出照常写入原来的 stdout。
+    """
+    def __init__(self, output, stream): self.output = output; self.stream = stream; self.thread_id = threading.get_ident()
+    def write(self, text):
+        if threading.get_ident() != self.thread_id: return self.stream.write(text)
+        if text: self.output.append_stdout(text)
+        return len(text)
+    def flush(self): self.stream.flush()
+
 class AnnotationApp:
     """
     一个多模式、带高级参数、美化过的、用于启动 CellTypeAnnotator 的应用封装 (最终美化版)
     """
-    def __init__(self, start_path: str = '.'):
+    def __init__(self, start_path: str = '.', cache_dir: str = None, profiler: Profiler = None, profile_editor: bool = False, cache_max_bytes: int = 512 << 20):
+        # 生成流程的阶段缓存：调整参数后重新生成时只重跑受影响的阶段 (cache_dir 可将结果持久化到磁盘)；
+        # 应用存活期间一直持有，内存占用以 cache_max_bytes 为上限，超出上限的整图解码结果不会常驻
+        self.stage_cache = StageCache(cache_dir=cache_dir, max_bytes=cache_max_bytes)
+        # 每次生成后在输出区显示各阶段耗时；传入自定义 Profiler 可开启内存统计、回调或 JSON Lines 输出。
+        # self.profiler 只作为配置模板：每次生成使用由它派生的新 Profiler (保存在 last_run_profiler)，记录不会无限累积；
+        # profile_editor=True 时每个编辑器另有自己的 Profiler，不与后台线程共用
+        self.profiler = profiler or Profiler(); self.profile_editor = profile_editor; self.last_run_profiler = None
+        # 生成与 CSV 读取在单个后台线程中运行 (NumPy/pandas 的计算大多释放 GIL，内核保持响应；阶段缓存仍在本进程内共享)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='annotator'); self._task = None; self._cancel_event = None
         # --- 定义通用布局样式 ---
         self.box_layout = widgets.Layout(border='1px solid #DDDDDD', padding='10px', margin='5px 0', border_radius='5px')
         fc_layout = widgets.Layout(width='98%', height='280px') # FileChooser 宽度设为98%以适应VBox
@@ -46,7 +81,8 @@ class AnnotationApp:
         self.img_mapping_box, self.img_dd_map = _create_mapping_ui()
         self.n_types_input = widgets.IntText(value=6, description='目标类别数:', style={'description_width': 'initial'})
         self.grid_width_input = widgets.IntText(value=50, description='网格宽度:', style={'description_width': 'initial'}); self.grid_height_input = widgets.IntText(value=50, description='网格高度:', style={'description_width': 'initial'}); self.remove_background_checkbox = widgets.Checkbox(value=True, description='移除背景区域'); self.background_color_input = widgets.Text(value='(255, 255, 255)', description='背景色 (R,G,B):', style={'description_width': 'initial'}); self.correct_black_checkbox = widgets.Checkbox(value=True, description='修正近黑区域'); self.black_threshold_input = widgets.IntText(value=60, description='近黑阈值 (R+G+B <):', style={'description_width': 'initial'})
-        adv_settings = widgets.VBox([widgets.HBox([self.grid_width_input, self.grid_height_input]), widgets.HBox([self.remove_background_checkbox, self.background_color_input]), widgets.HBox([self.correct_black_checkbox, self.black_threshold_input])])
+        self.cluster_backend_dropdown = widgets.Dropdown(options=[('K-Means', 'kmeans'), ('加权 K-Means', 'weighted_kmeans'), ('MiniBatch K-Means', 'minibatch'), ('中位切分 (快速)', 'median_cut')], value='kmeans', description='聚类算法:', style={'description_width': 'initial'})
+        adv_settings = widgets.VBox([widgets.HBox([self.grid_width_input, self.grid_height_input]), widgets.HBox([self.remove_background_checkbox, self.background_color_input]), widgets.HBox([self.correct_black_checkbox, self.black_threshold_input]), self.cluster_backend_dropdown])
         self.adv_accordion = widgets.Accordion(children=[adv_settings]); self.adv_accordion.set_title(0, '高级参数设置')
         self.generate_button = widgets.Button(description='从图像生成并编辑', button_style='success', icon='cogs', layout=widgets.Layout(width='99%'))
         
@@ -57,8 +93,8 @@ class AnnotationApp:
         tab1_content = widgets.VBox([tab1_fc_box, tab1_settings_box, self.generate_button])
 
         # --- Tab 2: 加载已有标注 ---
-        self.existing_csv_chooser = FileChooser(start_path, title='<b>步骤 1: 选择已有的标注CSV文件</b>', layout=fc_layout)
-        self.existing_csv_chooser.filter_pattern = ['*.csv']
+        self.existing_csv_chooser = FileChooser(start_path, title='<b>步骤 1: 选择已有的标注文件 (CSV 或 .npz)</b>', layout=fc_layout)
+        self.existing_csv_chooser.filter_pattern = ['*.csv', '*.npz']
         self.barcode_chooser_load = FileChooser(start_path, title='<b>步骤 2: 选择官方坐标 CSV (可选)</b>', layout=fc_layout)
         self.barcode_chooser_load.filter_pattern = ['*.csv']
         self.existing_mapping_box, self.existing_dd_map = _create_mapping_ui(show_type=True, show_barcode=True)
@@ -85,18 +121,23 @@ class AnnotationApp:
         tab3_content = widgets.VBox([widgets.HBox([blank_settings_box, blank_chooser_box]), self.create_blank_button])
         
         self.tab_widget = widgets.Tab(children=[tab1_content, tab2_content, tab3_content]); self.tab_widget.set_title(0, '从图像生成'); self.tab_widget.set_title(1, '加载已有标注'); self.tab_widget.set_title(2, '创建空白画布')
-        self.tool_container = widgets.Output(); self.app_layout = widgets.VBox([widgets.HTML("<h1>多功能空间注释平台</h1><hr>"), self.tab_widget, self.tool_container])
+        # 后台任务的进度条与取消按钮，首次运行任务时显示
+        self.progress_bar = widgets.FloatProgress(value=0.0, min=0.0, max=1.0, bar_style='info', layout=widgets.Layout(width='60%')); self.progress_label = widgets.HTML(value='')
+        self.cancel_button = widgets.Button(description='取消', icon='stop', button_style='danger', disabled=True)
+        self.progress_box = widgets.HBox([self.progress_bar, self.progress_label, self.cancel_button], layout=widgets.Layout(display='none', align_items='center'))
+        self.tool_container = widgets.Output(); self.app_layout = widgets.VBox([widgets.HTML("<h1>多功能空间注释平台</h1><hr>"), self.tab_widget, self.progress_box, self.tool_container])
         
         # 绑定事件
         self.barcode_chooser_img.register_callback(lambda chooser: self._populate_mappers(chooser, self.img_mapping_box, self.img_dd_map))
         self.existing_csv_chooser.register_callback(lambda chooser: self._populate_mappers(chooser, self.existing_mapping_box, self.existing_dd_map))
         self.barcode_chooser_load.register_callback(lambda chooser: self._populate_mappers(chooser, self.load_coords_mapping_box, self.load_coords_dd_map))
         self.barcode_chooser_blank.register_callback(lambda chooser: self._populate_mappers(chooser, self.blank_mapping_box, self.blank_dd_map))
-        self.generate_button.on_click(self._on_generate_click); self.start_editing_button.on_click(self._on_start_editing_click); self.create_blank_button.on_click(self._on_create_blank_click)
+        self.generate_button.on_click(self._on_generate_click); self.start_editing_button.on_click(self._on_start_editing_click); self.create_blank_button.on_click(self._on_create_blank_click); self.cancel_button.on_click(self._on_cancel_click)
 
     # (所有 _populate_mappers, _rename_df_cols 和 _on_click 等核心逻辑函数都保持不变)
     def _populate_mappers(self, chooser, mapping_box, dd_map):
         path = chooser.selected; mapping_box.layout.display = 'none'
+        if path and path.lower().endswith('.npz'): return  # 二进制会话文件的列名是固定的，无需匹配
         if path and os.path.exists(path):
             try:
                 cols = pd.read_csv(path, nrows=0).columns.tolist(); guesses = self._guess_column_names(cols)
@@ -105,77 +146,124 @@ class AnnotationApp:
                     if name in guesses: dd.value = guesses[name]
                 mapping_box.layout.display = 'block'
             except Exception as e: print(f"无法读取CSV文件: {e}")
-    def _guess_column_names(self, columns):
-        guesses = {}; cols_lower = {c.lower(): c for c in columns}
-        patterns = {'barcode': ['barcode', 'barcodes', 'cell_id'], 'x': ['x', 'x_coord', 'grid_x', 'array_col', 'x_coordinate'], 'y': ['y', 'y_coord', 'grid_y', 'array_row', 'y_coordinate'], 'type': ['type', 'cell_type', 'label', 'annotation', 'cluster']}
-        for key, p_list in patterns.items():
-            for p in p_list:
-                if p in cols_lower: guesses[key] = cols_lower[p]; break
-        return guesses
-    def _rename_df_cols(self, df, dd_map):
+    def _guess_column_names(self, columns): return guess_column_names(columns)
+    def _editor_profiler(self):
+        # tracemalloc 为进程级全局状态，可能与后台生成同时运行的编辑器计时不做内存统计
+        return self.profiler.spawn(memory=False) if self.profile_editor else None
+    def _column_choices(self, dd_map):
+        """列匹配下拉框的当前取值 {'barcode'/'x'/'y'/'type': 列名}；任务开始前取快照，后台线程不再读取控件"""
+        return {name: dd.value for name, dd in dd_map.items()}
+    def _rename_df_cols(self, df, columns):
         rename_map = {}
-        if 'barcode' in dd_map and dd_map['barcode'].value: rename_map[dd_map['barcode'].value] = 'barcode'
-        if 'x' in dd_map and dd_map['x'].value: rename_map[dd_map['x'].value] = 'grid_x'
-        if 'y' in dd_map and dd_map['y'].value: rename_map[dd_map['y'].value] = 'grid_y'
-        if 'type' in dd_map and dd_map['type'].value: rename_map[dd_map['type'].value] = 'cell_type'
+        if columns.get('barcode'): rename_map[columns['barcode']] = 'barcode'
+        if columns.get('x'): rename_map[columns['x']] = 'grid_x'
+        if columns.get('y'): rename_map[columns['y']] = 'grid_y'
+        if columns.get('type'): rename_map[columns['type']] = 'cell_type'
         return df.rename(columns=rename_map)
+    def _run_in_background(self, stages, work, on_done):
+        """
+        在后台线程中运行 work(progress, cancel)，期间内核与界面保持响应。progress(stage, fraction) 更新进度条 (按 stages 等分)，
+        并在取消按钮被按下后抛出 GenerationCancelled；work 中的 print 输出到输出区。
+        完成后回到内核事件循环 (主线程) 调用 on_done(结果)，编辑器在那里创建。
+        """
+        if self._task is not None and not self._task.done(): raise RuntimeError("已有后台任务正在运行。")
+        cancel = self._cancel_event = threading.Event()
+        def progress(stage, fraction):
+            index = stages.index(stage) if stage in stages else 0
+            self.progress_bar.value = (index + fraction) / len(stages); self.progress_label.value = f"{STAGE_LABELS.get(stage, stage)} {fraction:.0%}"
+            if cancel.is_set(): raise GenerationCancelled(f"已在「{STAGE_LABELS.get(stage, stage)}」阶段取消。")
+        def run():
+            with contextlib.redirect_stdout(_OutputStream(self.tool_container, sys.stdout)): return work(progress, cancel)
+        self._set_busy(True)
+        future = asyncio.get_event_loop().run_in_executor(self.executor, run)
+        self._task = asyncio.ensure_future(self._finish(future, on_done))
+        return self._task
+    async def _finish(self, future, on_done):
+        # on_done (创建编辑器) 也在 try 内：其异常同样显示在输出区，而不是留在无人等待的任务上
+        try:
+            result = await future
+            with contextlib.redirect_stdout(_OutputStream(self.tool_container, sys.stdout)): on_done(result)
+            self.progress_bar.value = 1.0; self.progress_bar.bar_style = 'success'; self.progress_label.value = "完成"
+        except GenerationCancelled as e: self.progress_bar.bar_style = 'warning'; self.progress_label.value = "<font color='orange'>已取消</font>"; self.tool_container.append_stdout(f"\n--- {e} ---\n")
+        except Exception as e: self.progress_bar.bar_style = 'danger'; self.progress_label.value = "<font color='red'>出错</font>"; self.tool_container.append_stdout(f"\n错误：{type(e).__name__}: {e}\n"); self.tool_container.append_stderr(traceback.format_exc())
+        finally: self._set_busy(False)
+    def _set_busy(self, busy: bool):
+        for button in (self.generate_button, self.start_editing_button, self.create_blank_button): button.disabled = busy
+        self.cancel_button.disabled = not busy
+        if busy: self.progress_bar.value = 0.0; self.progress_bar.bar_style = 'info'; self.progress_label.value = ''; self.progress_box.layout.display = 'flex'
+    def _on_cancel_click(self, b):
+        # 协作式取消：后台任务在下一个阶段或条带/数据块的边界处停止
+        if self._cancel_event is not None: self._cancel_event.set(); self.cancel_button.disabled = True; self.progress_label.value = "正在取消..."
+    def _show_editor(self, annotator):
+        """把编辑器追加到输出区 (在按钮回调之外也能显示)"""
+        self.tool_container.append_display_data(annotator.get_layout())
     def _on_generate_click(self, b):
         self.tool_container.clear_output(wait=True)
         with self.tool_container:
             img_path = self.image_chooser.selected; barcode_path = self.barcode_chooser_img.selected
             if not img_path or not os.path.exists(img_path): print("错误：请选择一个有效的图像文件。"); return
             grid_w = self.grid_width_input.value; grid_h = self.grid_height_input.value
-            if barcode_path and os.path.exists(barcode_path):
-                spatial_df = pd.read_csv(barcode_path); spatial_df = self._rename_df_cols(spatial_df, self.img_dd_map)
-                if 'barcode' not in spatial_df.columns: print("警告：坐标文件中缺少barcode列。"); spatial_df['barcode'] = [f"spot_{r.grid_y}_{r.grid_x}" for r in spatial_df.itertuples()]
-            else:
-                print("提示：未提供坐标CSV，将自动生成占位符barcodes。")
-                barcodes = [f"spot_{y}_{x}" for y in range(1, grid_h + 1) for x in range(1, grid_w + 1)]; x_coords = [x for y in range(1, grid_h + 1) for x in range(1, grid_w + 1)]; y_coords = [y for y in range(1, grid_h + 1) for x in range(1, grid_w + 1)]
-                spatial_df = pd.DataFrame({'barcode': barcodes, 'x_coord': x_coords, 'y_coord': y_coords})
+            has_coords = bool(barcode_path and os.path.exists(barcode_path)); dd_map = self._column_choices(self.img_dd_map)
+            if not has_coords: print("提示：未提供坐标CSV，将自动生成占位符barcodes。")
+            params = {'grid_width': grid_w, 'grid_height': grid_h, 'n_types': self.n_types_input.value, 'correct_near_black': self.correct_black_checkbox.value, 'near_black_threshold': self.black_threshold_input.value, 'remove_background': self.remove_background_checkbox.value, 'background_color_str': self.background_color_input.value, 'cluster_backend': self.cluster_backend_dropdown.value, 'cache': self.stage_cache}
+            stages = (('coords',) if has_coords else ()) + PIPELINE_STAGES
+        def work(progress, cancel):
+            if has_coords:
+                spatial_df = read_csv_chunked(barcode_path, on_chunk=lambda fraction: progress('coords', fraction)); spatial_df = self._rename_df_cols(spatial_df, dd_map)
+                if 'barcode' not in spatial_df.columns: print("警告：坐标文件中缺少barcode列。"); spatial_df['barcode'] = spot_barcodes(spatial_df['grid_x'], spatial_df['grid_y'])
+            else: spatial_df = placeholder_coordinates(grid_w, grid_h)
             spatial_df.rename(columns={'grid_x': 'x_coord', 'grid_y': 'y_coord'}, inplace=True)
-            params = {'grid_width': grid_w, 'grid_height': grid_h, 'n_types': self.n_types_input.value, 'correct_near_black': self.correct_black_checkbox.value, 'near_black_threshold': self.black_threshold_input.value, 'remove_background': self.remove_background_checkbox.value, 'background_color_str': self.background_color_input.value}
-            auto_annotations_df = process_cell_type_map(img_path, spatial_df, **params)
+            profiler = self.last_run_profiler = self.profiler.spawn()
+            return process_cell_type_map(img_path, spatial_df, progress=progress, cancel=cancel, profiler=profiler, **params), profiler
+        def on_done(result):
+            auto_annotations_df, profiler = result
+            print(f"--- 耗时: {profiler.summary()} ---")
             if not auto_annotations_df.empty:
                 print("\n--- 自动注释完成！正在启动交互式编辑器... ---")
-                annotator = CellTypeAnnotator(annotation_df=auto_annotations_df); display(annotator.get_layout())
+                self._show_editor(CellTypeAnnotator(annotation_df=auto_annotations_df, profiler=self._editor_profiler()))
             else: print("\n错误：自动注释过程未能生成任何结果。")
+        return self._run_in_background(stages, work, on_done)
     def _on_start_editing_click(self, b):
         self.tool_container.clear_output(wait=True)
         with self.tool_container:
             csv_path = self.existing_csv_chooser.selected
             if not csv_path or not os.path.exists(csv_path): print("错误：请选择一个有效的主标注文件。"); return
-            df = pd.read_csv(csv_path)
-            df = self._rename_df_cols(df, self.existing_dd_map)
-            if 'barcode' not in df.columns: df['barcode'] = [f"spot_{r.grid_y}_{r.grid_x}" for r in df.itertuples()]
-            if 'color' not in df.columns: df['color'] = [(128, 128, 128)] * len(df)
+            barcode_path = self.barcode_chooser_load.selected; has_coords = bool(barcode_path and os.path.exists(barcode_path))
+            existing_map = self._column_choices(self.existing_dd_map); coords_map = self._column_choices(self.load_coords_dd_map)
+            stages = ('annotations', 'coords') if has_coords else ('annotations',)
+        def work(progress, cancel):
+            if csv_path.lower().endswith('.npz'): progress('annotations', 0.0); df = load_annotations(csv_path)
+            else:
+                df = read_csv_chunked(csv_path, on_chunk=lambda fraction: progress('annotations', fraction))
+                df = self._rename_df_cols(df, existing_map)
+                if 'barcode' not in df.columns: df['barcode'] = spot_barcodes(df['grid_x'], df['grid_y'])
             master_coords_df = None
-            barcode_path = self.barcode_chooser_load.selected
-            if barcode_path and os.path.exists(barcode_path):
+            if has_coords:
                 print("--- 正在加载官方坐标文件用于Barcode重命名... ---")
-                master_coords_df = pd.read_csv(barcode_path); master_coords_df = self._rename_df_cols(master_coords_df, self.load_coords_dd_map)
+                master_coords_df = read_csv_chunked(barcode_path, on_chunk=lambda fraction: progress('coords', fraction)); master_coords_df = self._rename_df_cols(master_coords_df, coords_map)
+            return df, master_coords_df
+        def on_done(result):
+            df, master_coords_df = result
             print("\n--- 文件加载成功！正在启动交互式编辑器... ---")
-            annotator = CellTypeAnnotator(annotation_df=df, master_coordinate_df=master_coords_df)
-            display(annotator.get_layout())
+            self._show_editor(CellTypeAnnotator(annotation_df=df, master_coordinate_df=master_coords_df, profiler=self._editor_profiler()))
+        return self._run_in_background(stages, work, on_done)
     def _on_create_blank_click(self, b):
         self.tool_container.clear_output(wait=True)
-        with self.tool_container:
-            grid_w = self.blank_width_input.value; grid_h = self.blank_height_input.value
-            df = pd.DataFrame({'grid_x': [x for y in range(1, grid_h + 1) for x in range(1, grid_w + 1)], 'grid_y': [y for y in range(1, grid_h + 1) for x in range(1, grid_w + 1)], 'cell_type': 'Unassigned', 'color': [(255, 255, 255)] * (grid_w * grid_h)})
+        grid_w = self.blank_width_input.value; grid_h = self.blank_height_input.value
+        barcode_path = self.barcode_chooser_blank.selected; has_coords = bool(barcode_path and os.path.exists(barcode_path)); dd_map = self._column_choices(self.blank_dd_map)
+        def work(progress, cancel):
+            df = placeholder_coordinates(grid_w, grid_h).rename(columns={'x_coord': 'grid_x', 'y_coord': 'grid_y'}); df['cell_type'] = pd.Categorical(['Unassigned'] * len(df)); df['r'] = df['g'] = df['b'] = np.uint8(255)
             master_coords_df = None
-            barcode_path = self.barcode_chooser_blank.selected
-            if barcode_path and os.path.exists(barcode_path):
+            if has_coords:
                 print("--- 正在加载官方坐标文件用于提供Barcode... ---")
-                master_coords_df = pd.read_csv(barcode_path); master_coords_df = self._rename_df_cols(master_coords_df, self.blank_dd_map)
-            if master_coords_df is not None and 'barcode' in master_coords_df.columns:
-                df = pd.merge(df.drop(columns=['barcode'], errors='ignore'), master_coords_df[['grid_x', 'grid_y', 'barcode']], on=['grid_x', 'grid_y'], how='left')
-            if 'barcode' not in df.columns: df['barcode'] = [f"spot_{r.grid_y}_{r.grid_x}" for r in df.itertuples()]
-            unmatched_mask = df['barcode'].isnull()
-            if unmatched_mask.any():
-                new_barcodes = [f"spot_{r.grid_y}_{r.grid_x}" for r in df[unmatched_mask].itertuples()]
-                df.loc[unmatched_mask, 'barcode'] = new_barcodes
+                master_coords_df = read_csv_chunked(barcode_path, on_chunk=lambda fraction: progress('coords', fraction)); master_coords_df = self._rename_df_cols(master_coords_df, dd_map)
+            if master_coords_df is not None and 'barcode' in master_coords_df.columns: df['barcode'], _ = match_barcodes(df, master_coords_df)
+            return df, master_coords_df
+        def on_done(result):
+            df, master_coords_df = result
             print("\n--- 空白画布创建成功！正在启动交互式编辑器... ---")
-            annotator = CellTypeAnnotator(annotation_df=df, master_coordinate_df=master_coords_df)
-            display(annotator.get_layout())
+            self._show_editor(CellTypeAnnotator(annotation_df=df, master_coordinate_df=master_coords_df, profiler=self._editor_profiler()))
+        return self._run_in_background(('coords',), work, on_done)
     
     def display_app(self):
         display(self.app_layout)
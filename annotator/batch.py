@@ -0,0 +1,140 @@
+# annotator/batch.py
+"""
+无界面的批量自动注释：对一个目录 (或清单 CSV) 中的多张切片图像并行运行 process_cell_type_map，
+每张切片输出一个 barcode,grid_x,grid_y,cell_type,color 格式的 CSV。
+
+用法示例:
+    python -m annotator.batch slides/ -o annotations/ --workers 8 --grid-width 128 --grid-height 128
+    python -m annotator.batch manifest.csv -o annotations/   # 清单需包含 image 列，可选 coords / output 列
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+from .image_processing import process_cell_type_map, TILE_REDUCERS
+from .clustering import CLUSTER_BACKENDS
+from .cache import StageCache
+from .profiling import Profiler
+from .io import read_coordinates, placeholder_coordinates, save_annotations
+
+IMAGE_EXTENSIONS = ('.tif', '.tiff', '.jpg', '.jpeg', '.png')
+SUMMARY_FILENAME = 'batch_summary.json'
+
+def discover_jobs(input_path: str, output_dir: str, coords_dir: str = None):
+    """
+    根据输入目录或清单 CSV 生成任务列表，每项为 {'slide', 'image', 'coords', 'output'}。
+    目录模式下，坐标文件为 coords_dir (默认与图像同目录) 中与图像同名的 .csv，不存在时使用占位符网格。
+    多个任务的输出路径相同时抛出 ValueError。
+    """
+    jobs = []
+    if os.path.isdir(input_path):
+        coords_dir = coords_dir or input_path
+        for name in sorted(os.listdir(input_path)):
+            stem, ext = os.path.splitext(name)
+            if ext.lower() not in IMAGE_EXTENSIONS: continue
+            coords = os.path.join(coords_dir, stem + '.csv')
+            jobs.append({'slide': stem, 'image': os.path.join(input_path, name), 'coords': coords if os.path.exists(coords) else None, 'output': os.path.join(output_dir, f"{stem}_annotations.csv")})
+    else:
+        manifest = pd.read_csv(input_path); base_dir = os.path.dirname(os.path.abspath(input_path))
+        if 'image' not in manifest.columns: raise ValueError(f"清单 {input_path} 缺少 'image' 列。")
+        resolve = lambda p: p if os.path.isabs(p) else os.path.join(base_dir, p)
+        for row in manifest.to_dict('records'):
+            image = resolve(row['image']); stem = os.path.splitext(os.path.basename(image))[0]
+            coords = row.get('coords'); output = row.get('output')
+            jobs.append({'slide': stem, 'image': image, 'coords': resolve(coords) if isinstance(coords, str) and coords else None,
+                         'output': resolve(output) if isinstance(output, str) and output else os.path.join(output_dir, f"{stem}_annotations.csv")})
+    # 同名不同扩展名的图像 (如 slide.tif 与 slide.png) 会写到同一输出文件，并行时互相覆盖
+    outputs = {}
+    for job in jobs: outputs.setdefault(os.path.normcase(os.path.abspath(job['output'])), []).append(job['image'])
+    conflicts = [images for images in outputs.values() if len(images) > 1]
+    if conflicts: raise ValueError("以下图像对应同一个输出文件，请重命名或在清单中指定 output 列: " + "; ".join(", ".join(images) for images in conflicts))
+    return jobs
+
+def process_slide(job: dict, params: dict, cache_dir: str = None, verbose: bool = False) -> dict:
+    """处理单张切片并以原子方式写出结果，返回包含状态、耗时与点数的记录 (不抛出异常)"""
+    record = {**job, 'status': 'done', 'seconds': 0.0, 'n_spots': 0, 'error': None, 'stages': []}
+    start = time.perf_counter(); profiler = Profiler()
+    try:
+        if job['coords']: spatial_df = read_coordinates(job['coords'])
+        else: spatial_df = placeholder_coordinates(params.get('grid_width', 50), params.get('grid_height', 50))
+        run_params = {**params, 'cache': StageCache(cache_dir=cache_dir) if cache_dir else None, 'profiler': profiler}
+        with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+            result_df = process_cell_type_map(job['image'], spatial_df, **run_params)
+        os.makedirs(os.path.dirname(os.path.abspath(job['output'])), exist_ok=True)
+        tmp_path = job['output'] + '.tmp'
+        save_annotations(result_df, tmp_path, 'npz' if job['output'].lower().endswith('.npz') else 'csv'); os.replace(tmp_path, job['output'])
+        record['n_spots'] = len(result_df)
+    except Exception as e:
+        record['status'] = 'failed'; record['error'] = f"{type(e).__name__}: {e}"
+    record['seconds'] = round(time.perf_counter() - start, 3); record['stages'] = profiler.records
+    return record
+
+def run_batch(input_path: str, output_dir: str, params: dict = None, workers: int = None, coords_dir: str = None, overwrite: bool = False, cache_dir: str = None, verbose: bool = False) -> dict:
+    """
+    批量处理入口：已存在输出文件的切片默认跳过 (可断点续跑)，其余切片在进程池中并行处理。
+    返回汇总报告，并写入 output_dir/batch_summary.json。
+    """
+    params = params or {}; os.makedirs(output_dir, exist_ok=True)
+    jobs = discover_jobs(input_path, output_dir, coords_dir)
+    records = []; pending = []
+    for job in jobs:
+        if not overwrite and os.path.exists(job['output']): records.append({**job, 'status': 'skipped', 'seconds': 0.0, 'n_spots': None, 'error': None, 'stages': []})
+        else: pending.append(job)
+    print(f"--- 共 {len(jobs)} 张切片：跳过 {len(records)} 张已完成，待处理 {len(pending)} 张 ---")
+    start = time.perf_counter()
+    def _report(record):
+        records.append(record)
+        detail = f"{record['n_spots']} 个点" if record['status'] == 'done' else record['error']
+        print(f"  [{len(records)}/{len(jobs)}] {record['slide']}: {record['status']} ({record['seconds']:.2f}s) {detail}")
+    if workers == 1 or len(pending) <= 1:
+        for job in pending: _report(process_slide(job, params, cache_dir, verbose))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(process_slide, job, params, cache_dir, verbose) for job in pending]
+            for future in as_completed(futures): _report(future.result())
+    order = {job['output']: i for i, job in enumerate(jobs)}; records.sort(key=lambda r: order[r['output']])
+    counts = {status: sum(r['status'] == status for r in records) for status in ('done', 'skipped', 'failed')}
+    summary = {'input': input_path, 'output_dir': output_dir, 'params': params, 'workers': workers, 'wall_seconds': round(time.perf_counter() - start, 3), **counts, 'slides': records}
+    with open(os.path.join(output_dir, SUMMARY_FILENAME), 'w', encoding='utf-8') as f: json.dump(summary, f, ensure_ascii=False, indent=2, default=str)
+    print(f"--- 完成：成功 {counts['done']}，跳过 {counts['skipped']}，失败 {counts['failed']}，总耗时 {summary['wall_seconds']:.2f}s ---")
+    return summary
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='python -m annotator.batch', description='批量运行空间组织图像的自动注释。')
+    parser.add_argument('input', help='图像目录，或包含 image[, coords, output] 列的清单 CSV')
+    parser.add_argument('-o', '--output-dir', default='annotations', help='输出目录 (默认: annotations)')
+    parser.add_argument('--coords-dir', default=None, help='目录模式下与图像同名的坐标 CSV 所在目录 (默认与图像同目录)')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='并行进程数 (默认: CPU 核数)')
+    parser.add_argument('--overwrite', action='store_true', help='重新处理已有输出的切片')
+    parser.add_argument('--cache-dir', default=None, help='阶段缓存目录，重复运行时复用已计算的阶段结果')
+    parser.add_argument('-v', '--verbose', action='store_true', help='输出每张切片的处理步骤')
+    group = parser.add_argument_group('注释参数')
+    group.add_argument('--grid-width', type=int, default=50); group.add_argument('--grid-height', type=int, default=50)
+    group.add_argument('--n-types', type=int, default=6)
+    group.add_argument('--near-black-threshold', type=int, default=60)
+    group.add_argument('--no-correct-near-black', dest='correct_near_black', action='store_false')
+    group.add_argument('--keep-background', dest='remove_background', action='store_false')
+    group.add_argument('--background-color', dest='background_color_str', default='(255, 255, 255)')
+    group.add_argument('--tile-reducer', choices=TILE_REDUCERS, default='mode')
+    group.add_argument('--cluster-backend', choices=CLUSTER_BACKENDS, default='kmeans')
+    group.add_argument('--sampling', choices=('dense', 'sparse'), default='dense')
+    group.add_argument('--streaming', action='store_true', help='按条带流式读取图像 (需要 tifffile)')
+    return parser
+
+PARAM_NAMES = ('grid_width', 'grid_height', 'n_types', 'near_black_threshold', 'correct_near_black', 'remove_background', 'background_color_str', 'tile_reducer', 'cluster_backend', 'sampling', 'streaming')
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    params = {name: getattr(args, name) for name in PARAM_NAMES}
+    try: summary = run_batch(args.input, args.output_dir, params, workers=args.workers, coords_dir=args.coords_dir, overwrite=args.overwrite, cache_dir=args.cache_dir, verbose=args.verbose)
+    except ValueError as e: print(f"错误: {e}", file=sys.stderr); return 2
+    return 1 if summary['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+# annotator/cache.py
+
+import os
+import pickle
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+# (绝对路径, 修改时间, 文件大小) -> 内容哈希，避免同一文件被重复完整读取
+_file_hash_memo = {}
+
+def file_content_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    """按块读取文件并返回其内容哈希；文件未修改时直接复用上次的结果"""
+    stat = os.stat(path); memo_key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if memo_key not in _file_hash_memo:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''): digest.update(chunk)
+        _file_hash_memo[memo_key] = digest.hexdigest()
+    return _file_hash_memo[memo_key]
+
+def array_hash(arr) -> str:
+    """返回 NumPy 数组 (含形状与类型) 的哈希；arr 为 None 时返回 None"""
+    if arr is None: return None
+    arr = np.ascontiguousarray(arr)
+    digest = hashlib.blake2b(repr((arr.shape, arr.dtype.str)).encode(), digest_size=16); digest.update(arr.tobytes())
+    return digest.hexdigest()
+
+def frame_hash(df: pd.DataFrame) -> str:
+    """返回 DataFrame 内容 (含列名) 的哈希"""
+    digest = hashlib.blake2b(repr(list(df.columns)).encode(), digest_size=16)
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def stage_key(stage: str, key_parts) -> str:
+    """由阶段名与其依赖的参数 (包括上游阶段的键) 生成缓存键"""
+    return hashlib.blake2b(repr((stage, key_parts)).encode(), digest_size=16).hexdigest()
+
+def value_nbytes(value) -> int:
+    """估计缓存值占用的内存：统计其中 NumPy 数组与 DataFrame 的字节数 (递归进入元组/列表/字典与对象属性)"""
+    if isinstance(value, np.ndarray): return value.nbytes
+    if isinstance(value, (pd.DataFrame, pd.Series)): return int(np.sum(value.memory_usage(index=True, deep=False)))
+    if isinstance(value, (tuple, list)): return sum(value_nbytes(v) for v in value)
+    if isinstance(value, dict): return sum(value_nbytes(v) for v in value.values())
+    if hasattr(value, '__dict__'): return sum(value_nbytes(v) for v in vars(value).values())
+    return 0
+
+class StageCache:
+    """
+    生成流程各阶段结果的缓存：内存中保留最近使用的结果 (LRU)，项数不超过 max_entries、
+    数组总字节数不超过 max_bytes (单项超过 max_bytes 时不放入内存；如整图解码结果)。
+    指定 cache_dir 时，允许持久化的阶段结果还会以 pickle 文件写入磁盘，重启内核后仍可复用。
+    """
+    def __init__(self, max_entries: int = 32, cache_dir: str = None, max_bytes: int = 512 << 20):
+        self.max_entries = max_entries; self.max_bytes = max_bytes; self.cache_dir = cache_dir
+        self._entries = OrderedDict(); self._sizes = {}; self.nbytes = 0; self.hits = 0; self.misses = 0
+        if cache_dir: os.makedirs(cache_dir, exist_ok=True)
+
+    def _disk_path(self, stage, key): return os.path.join(self.cache_dir, f"{stage}-{key}.pkl")
+
+    def get(self, stage: str, key: str, default=None):
+        if (stage, key) in self._entries:
+            self._entries.move_to_end((stage, key)); self.hits += 1
+            return self._entries[(stage, key)]
+        if self.cache_dir and os.path.exists(self._disk_path(stage, key)):
+            try:
+                with open(self._disk_path(stage, key), 'rb') as f: value = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError): pass
+            else: self._remember(stage, key, value); self.hits += 1; return value
+        self.misses += 1
+        return default
+
+    def put(self, stage: str, key: str, value, persist: bool = True):
+        self._remember(stage, key, value)
+        if persist and self.cache_dir:
+            tmp_path = self._disk_path(stage, key) + '.tmp'
+            with open(tmp_path, 'wb') as f: pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._disk_path(stage, key))
+
+    def _remember(self, stage, key, value):
+        size = value_nbytes(value); self._forget((stage, key))
+        if self.max_bytes is not None and size > self.max_bytes: return
+        self._entries[(stage, key)] = value; self._sizes[(stage, key)] = size; self.nbytes += size
+        while len(self._entries) > self.max_entries or (self.max_bytes is not None and self.nbytes > self.max_bytes): self._forget(next(iter(self._entries)))
+
+    def _forget(self, entry):
+        if entry in self._entries: del self._entries[entry]; self.nbytes -= self._sizes.pop(entry)
+
+    def clear(self, disk: bool = False):
+        """清空内存缓存；disk=True 时一并删除磁盘上的缓存文件"""
+        self._entries.clear(); self._sizes.clear(); self.nbytes = 0
+        if disk and self.cache_dir:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.pkl'): os.remove(os.path.join(self.cache_dir, name))
+
+_MISSING = object()
+
+def cached_stage(cache, stage: str, key_parts, compute, persist: bool = True):
+    """
+    运行一个流程阶段并返回 (结果, 缓存键, 是否命中缓存)。cache 为 None 时直接计算，缓存键为 None；
+    否则以 key_parts 生成的键查找缓存，未命中时计算并写入。key_parts 可以是可调用对象，仅在启用缓存时求值。
+    """
+    if cache is None: return compute(), None, False
+    key = stage_key(stage, key_parts() if callable(key_parts) else key_parts)
+    value = cache.get(stage, key, _MISSING)
+    if value is not _MISSING: return value, key, True
+    value = compute(); cache.put(stage, key, value, persist=persist)
+    return value, key, False
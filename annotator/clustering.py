@@ -0,0 +1,107 @@
+# annotator/clustering.py
+
+import numpy as np
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+# 可选的颜色聚类后端
+CLUSTER_BACKENDS = ('kmeans', 'weighted_kmeans', 'minibatch', 'median_cut')
+# 查找表尚未编译且待查颜色不超过该数量时直接计算，不值得为少量颜色编译 2**24 的查找表
+DIRECT_LOOKUP_MAX = 1 << 16
+
+def _pack_rgb(pixels):
+    """将 (..., 3) 的 RGB 数组打包为 24 位整数键"""
+    pixels = np.asarray(pixels)
+    return (pixels[..., 0].astype(np.int32) << 16) | (pixels[..., 1].astype(np.int32) << 8) | pixels[..., 2].astype(np.int32)
+
+def _unpack_rgb(keys):
+    """将 24 位整数键还原为 (..., 3) 的 uint8 RGB 数组"""
+    keys = np.asarray(keys)
+    return np.stack([(keys >> 16) & 0xFF, (keys >> 8) & 0xFF, keys & 0xFF], axis=-1).astype(np.uint8)
+
+def _median_cut(colors, weights, n_types):
+    """按频数加权的中位切分：反复沿跨度最大的通道在加权中位数处切开颜色盒，返回各盒的加权平均色"""
+    boxes = [np.arange(len(colors))]
+    while len(boxes) < n_types:
+        best, best_range, best_channel = None, 0, 0
+        for i, idx in enumerate(boxes):
+            if len(idx) < 2: continue
+            ranges = colors[idx].max(axis=0) - colors[idx].min(axis=0)
+            if ranges.max() > best_range: best, best_range, best_channel = i, ranges.max(), int(ranges.argmax())
+        if best is None: break
+        idx = boxes[best]; order = idx[np.argsort(colors[idx, best_channel], kind='stable')]
+        cum = np.cumsum(weights[order]); cut = int(np.clip(np.searchsorted(cum, cum[-1] / 2) + 1, 1, len(order) - 1))
+        boxes[best] = order[:cut]; boxes.append(order[cut:])
+    return np.array([np.average(colors[idx], axis=0, weights=weights[idx]) for idx in boxes])
+
+class ColorPalette:
+    """
+    聚类得到的颜色中心及其 24 位 RGB → 类别编号查找表 (LUT)。
+    近黑色 (R+G+B < near_black_threshold) 与背景色在表中记为 -1 (Unassigned)，其余颜色取最近的中心；
+    查找表在首次使用时编译，之后为任意颜色集合打标签只需一次数组索引。
+    """
+    def __init__(self, centers, near_black_threshold: int, background_color):
+        self.centers = np.asarray(centers, dtype=np.float64)
+        self.near_black_threshold = near_black_threshold; self.background_color = tuple(background_color)
+        self._lut = None
+
+    @property
+    def n_types(self): return len(self.centers)
+
+    def __getstate__(self):
+        # 查找表可随时重建，不写入缓存文件
+        state = self.__dict__.copy(); state['_lut'] = None
+        return state
+
+    def compile(self) -> np.ndarray:
+        """编译并返回长度为 2**24 的查找表 (按 R 通道逐片计算，距离在 G/B 上可分离)"""
+        if self._lut is None:
+            lut = np.empty((256, 256 * 256), dtype=np.int8 if self.n_types < 128 else np.int16)
+            levels = np.arange(256, dtype=np.float64)
+            # ||x - c||^2 去掉与中心无关的 ||x||^2 后为 ||c||^2 - 2x·c，三个通道的项可分别预计算
+            gb_term = ((self.centers ** 2).sum(axis=1) - 2 * levels[:, None, None] * self.centers[:, 1] - 2 * levels[None, :, None] * self.centers[:, 2]).reshape(256 * 256, -1)
+            gb_sum = (levels[:, None] + levels[None, :]).ravel()
+            for r in range(256):
+                labels = np.argmin(gb_term - 2 * r * self.centers[:, 0], axis=1)
+                labels[gb_sum + r < self.near_black_threshold] = -1
+                lut[r] = labels
+            lut = lut.ravel(); lut[int(_pack_rgb(self.background_color))] = -1
+            self._lut = lut
+        return self._lut
+
+    def _direct_labels(self, keys) -> np.ndarray:
+        # 与 compile() 中的距离项按相同顺序计算，保证结果与查找表一致
+        r, g, b = (((keys >> shift) & 0xFF).astype(np.float64)[:, None] for shift in (16, 8, 0))
+        labels = np.argmin(((self.centers ** 2).sum(axis=1) - 2 * g * self.centers[:, 1] - 2 * b * self.centers[:, 2]) - 2 * r * self.centers[:, 0], axis=1)
+        labels[(r + g + b)[:, 0] < self.near_black_threshold] = -1; labels[keys == int(_pack_rgb(self.background_color))] = -1
+        return labels
+
+    def lookup(self, keys) -> np.ndarray:
+        """按 24 位颜色键返回类别编号 (0 起始，-1 表示 Unassigned)"""
+        keys = np.asarray(keys)
+        if self._lut is None:
+            # 按不同颜色数 (而非网格数) 决定：颜色少时直接计算，避免编译 2^24 项的查找表
+            unique_keys, inverse = np.unique(keys, return_inverse=True)
+            if unique_keys.size <= DIRECT_LOOKUP_MAX: return self._direct_labels(unique_keys.astype(np.int64))[inverse].reshape(keys.shape)
+        return self.compile()[keys]
+
+    def type_names(self, keys) -> np.ndarray:
+        """按 24 位颜色键返回 'Type_N' / 'Unassigned' 名称数组"""
+        names = np.array([f"Type_{i+1}" for i in range(self.n_types)] + ['Unassigned'], dtype=object)
+        return names[self.lookup(keys)]
+
+def fit_color_palette(colors, counts, n_types: int, near_black_threshold: int, background_color, backend: str = 'kmeans'):
+    """
+    在唯一颜色 colors (N, 3) 及其网格频数 counts 上聚类，返回 ColorPalette；无可用颜色时返回 None。
+    kmeans 与原实现一致 (唯一色不加权)；weighted_kmeans / minibatch 按频数加权；median_cut 为不依赖迭代的快速量化。
+    """
+    if backend not in CLUSTER_BACKENDS: raise ValueError(f"未知的聚类后端: {backend!r}，可选值为 {CLUSTER_BACKENDS}")
+    colors = np.asarray(colors, dtype=np.int32).reshape(-1, 3); counts = np.asarray(counts, dtype=np.float64)
+    usable = (colors.sum(axis=1) >= near_black_threshold) & (_pack_rgb(colors) != int(_pack_rgb(background_color)))
+    colors, counts = colors[usable], counts[usable]
+    n_types = min(n_types, len(colors))
+    if n_types <= 0: return None
+    if backend == 'kmeans': centers = KMeans(n_clusters=n_types, random_state=42, n_init=10).fit(colors).cluster_centers_
+    elif backend == 'weighted_kmeans': centers = KMeans(n_clusters=n_types, random_state=42, n_init=10).fit(colors, sample_weight=counts).cluster_centers_
+    elif backend == 'minibatch': centers = MiniBatchKMeans(n_clusters=n_types, random_state=42, n_init=3, batch_size=4096).fit(colors, sample_weight=counts).cluster_centers_
+    else: centers = _median_cut(colors, counts, n_types)
+    return ColorPalette(centers, near_black_threshold, background_color)
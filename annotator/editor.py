@@ -4,18 +4,24 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.widgets import LassoSelector
-from matplotlib.path import Path
 import ipywidgets as widgets
 from IPython.display import display
-import ast, os
+import os
 from scipy.spatial import KDTree
+from .history import Edit, EditHistory
+from .spatial import GridIndex, CoordinateIndex
+from .profiling import profiled
+from .io import compact_annotations, save_annotations, match_barcodes, COLOR_COLUMNS
+from .export import export_annotation_map
 
 class CellTypeAnnotator:
     """
     """
-    def __init__(self, annotation_df: pd.DataFrame, master_coordinate_df: pd.DataFrame = None):
+    def __init__(self, annotation_df: pd.DataFrame, master_coordinate_df: pd.DataFrame = None, history_depth: int = 20, history_max_bytes: int = None, history_journal: str = None, profiler=None, history: EditHistory = None, types=None, history_overwrite: bool = False):
         plt.ioff(); self.fig, self.ax = plt.subplots(figsize=(7, 7)); plt.ion()
         self.df = annotation_df.copy()
+        # 传入 Profiler 时记录每个编辑操作 (渲染、套索、改类型、撤销、保存等) 的耗时
+        self.profiler = profiler
         
         self.master_coords = master_coordinate_df
         self.coord_kdtree = None
@@ -24,72 +30,154 @@ class CellTypeAnnotator:
             print("INFO: 检测到官方坐标文件，开始处理...")
             required_cols = ['barcode', 'grid_x', 'grid_y']
             if all(col in self.master_coords.columns for col in required_cols):
-                self.coord_kdtree = KDTree(self.master_coords[['grid_x', 'grid_y']].values)
+                self.coord_kdtree = KDTree(self.master_coords[['grid_x', 'grid_y']].values); self.master_barcodes = self.master_coords['barcode'].to_numpy(dtype=object)
                 print("  - 已创建坐标 KD-Tree 用于智能新增点。")
-                if 'barcode' in self.df.columns: self.df.drop(columns=['barcode'], inplace=True)
-                self.df = pd.merge(self.df, self.master_coords[['grid_x', 'grid_y', 'barcode']], on=['grid_x', 'grid_y'], how='left')
-                unmatched_mask = self.df['barcode'].isnull()
-                if unmatched_mask.any():
-                    print(f"  - 警告: {unmatched_mask.sum()} 个点在官方坐标文件中未找到完美匹配。")
-                    new_barcodes = [f"unmatched_spot_{r.grid_y}_{r.grid_x}" for r in self.df[unmatched_mask].itertuples()]
-                    self.df.loc[unmatched_mask, 'barcode'] = new_barcodes
+                self.df['barcode'], unmatched_mask = match_barcodes(self.df, self.master_coords, prefix='unmatched_spot')
+                if unmatched_mask.any(): print(f"  - 警告: {unmatched_mask.sum()} 个点在官方坐标文件中未找到完美匹配。")
                 print("  - Barcode 重命名完成。")
             else:
                 print("警告：官方坐标文件缺少 'barcode', 'grid_x', 或 'grid_y' 列，将被忽略。")
                 self.master_coords = None
         
-        if 'color' in self.df.columns and not self.df.empty and isinstance(self.df['color'].iloc[0], str):
-            try: self.df['color'] = self.df['color'].apply(ast.literal_eval)
-            except (ValueError, SyntaxError): print("警告: 'color' 列包含无效格式。")
-        self.df_history = [self.df.copy()]
-        if 'cell_type' not in self.df.columns: self.df['cell_type'] = 'Unassigned'
-        self.df['cell_type'] = self.df['cell_type'].astype(str)
-        self.unique_types_initial = sorted(list(self.df['cell_type'].unique()))
-        self.types_history = [self.unique_types_initial.copy()]
+        # 紧凑表示：类别型 cell_type、uint8 的 r/g/b 列与 int32 坐标
+        try: self.df = compact_annotations(self.df)
+        except ValueError: print("警告: 'color' 列包含无效格式。"); self.df = compact_annotations(self.df.drop(columns=['color']))
+        # (grid_x, grid_y) → 行号索引，随新增/删除/撤销增量维护，用于新增点时的重复检查
+        self.coord_index = CoordinateIndex(self.df['grid_x'].to_numpy(), self.df['grid_y'].to_numpy())
+        # types 为恢复会话时的完整类别列表 (含尚无点的新建类别)
+        self.unique_types_initial = sorted(types) if types is not None else sorted(list(self.df['cell_type'].unique()))
+        # 增量撤销/重做日志；指定 history_journal 时操作同时写入磁盘 (已有日志默认不覆盖，history_overwrite=True 时备份为 .bak)，
+        # 内核重启后用 CellTypeAnnotator.from_journal 恢复；传入 history 时沿用其撤销/重做栈
+        self.history = history if history is not None else EditHistory(self.df, self.unique_types_initial, max_depth=history_depth, max_bytes=history_max_bytes, journal_path=history_journal, overwrite_journal=history_overwrite)
         self.selected_indices = np.array([], dtype=int); self.highlight_plot = None; self.shift_pressed = False; self.ctrl_pressed = False
-        self._create_widgets(); self._update_plot()
+        self._create_widgets(); self._init_plot(); self._update_plot(); self._refresh_history_buttons()
         self.fig.canvas.mpl_connect('key_press_event', self._on_key_press)
         self.fig.canvas.mpl_connect('key_release_event', self._on_key_release)
         self.fig.canvas.mpl_connect('button_press_event', self._on_canvas_click)
+        self.fig.canvas.mpl_connect('draw_event', self._on_draw)
+
+    @classmethod
+    def from_journal(cls, journal_path: str, master_coordinate_df: pd.DataFrame = None, history_depth: int = None, history_max_bytes: int = None, profiler=None):
+        """
+        由 history_journal 日志恢复会话 (内核重启后)：表格、全部类别与撤销/重做栈均与中断前一致，后续操作继续写入同一日志。
+        history_depth / history_max_bytes 为 None 时沿用原会话保存在日志中的上限。
+        """
+        limits = {k: v for k, v in (('max_depth', history_depth), ('max_bytes', history_max_bytes)) if v is not None}
+        df, types, history = EditHistory.replay(journal_path, **limits)
+        return cls(df, master_coordinate_df=master_coordinate_df, profiler=profiler, history=history, types=types)
+
+    @property
+    def selected_indices(self): return np.flatnonzero(self.selected_mask)
+    @selected_indices.setter
+    def selected_indices(self, indices):
+        # 选区以布尔掩码保存，行号形式仅为兼容保留
+        self.selected_mask = np.zeros(len(self.df), dtype=bool); self.selected_mask[np.asarray(indices, dtype=np.int64)] = True
 
     def get_layout(self): # <-- 核心修正：函数重命名
         """将所有组件组合成一个布局对象并返回"""
-        controls = widgets.VBox([self.info_label, self.accordion, self.undo_button, widgets.HBox([self.filename_input, self.save_button])])
-        main_container = widgets.VBox([self.fig.canvas, controls])
+        main_container = widgets.VBox([self.fig.canvas, self.controls_layout])
         main_container.layout.margin = '0 0 0 50px'
         return main_container
 
     # (其余所有函数 _create_widgets, _update_plot, _on_click 等都与上一版相同，为简洁省略)
-    def _create_widgets(self): self.unique_types_initial = sorted(self.df['cell_type'].unique()); self.type_dropdown = widgets.Dropdown(options=self.unique_types_initial, description='目标类型:'); self.update_as_new_input = widgets.Text(value='', placeholder='...或设为新类型', description='', layout=widgets.Layout(width='150px')); self.update_button = widgets.Button(description="更新选中点", icon='pencil', button_style='primary'); self.delete_points_button = widgets.Button(description="删除选中点", icon='trash', button_style='danger'); self.add_point_toggle = widgets.ToggleButton(value=False, description='新增点模式', tooltip='激活后，单击画布可新增点', icon='plus-circle'); edit_points_box = widgets.VBox([widgets.HTML("<b>1. 用套索选择 (按住Shift增选, Ctrl/Cmd减选) 或激活新增点模式</b>"), widgets.HBox([self.type_dropdown, self.update_as_new_input, self.update_button]), widgets.HBox([self.add_point_toggle, self.delete_points_button])]); self.new_type_input = widgets.Text(value='', placeholder='输入新类别名', description='新类别名:'); self.create_type_button = widgets.Button(description="创建", icon='plus', button_style='success'); self.rename_from_dropdown = widgets.Dropdown(options=self.unique_types_initial, description='旧名称:'); self.rename_to_input = widgets.Text(value='', placeholder='输入新名称', description='新名称:'); self.rename_button = widgets.Button(description="重命名", icon='edit'); self.delete_type_dropdown = widgets.Dropdown(options=self.unique_types_initial, description='要删除的类别:'); self.delete_points_checkbox = widgets.Checkbox(value=True, description='同时删除属于该类型的点'); self.delete_type_button = widgets.Button(description="删除类别", icon='trash-o', button_style='danger'); manage_categories_box = widgets.VBox([widgets.HTML("<b>创建新类别:</b>"), widgets.HBox([self.new_type_input, self.create_type_button]), widgets.HTML("<hr style='margin: 10px 0;'>"), widgets.HTML("<b>重命名类别:</b>"), widgets.HBox([self.rename_from_dropdown, self.rename_to_input, self.rename_button]), widgets.HTML("<hr style='margin: 10px 0;'>"), widgets.HTML("<b>删除类别:</b>"), widgets.HBox([self.delete_type_dropdown, self.delete_points_checkbox, self.delete_type_button])]); self.accordion = widgets.Accordion(children=[edit_points_box, manage_categories_box]); self.accordion.set_title(0, '编辑点 (Edit Points)'); self.accordion.set_title(1, '管理类别 (Manage Categories)'); self.undo_button = widgets.Button(description="撤销上一步 (Undo)", icon='undo', button_style='warning', disabled=True); self.info_label = widgets.HTML(value="<b>状态:</b> 欢迎！请用鼠标在图上框选点。"); self.filename_input = widgets.Text(value='corrected_annotations.csv', description='输出文件名:', style={'description_width': 'initial'}); self.save_button = widgets.Button(description="保存到 CSV", icon='save', button_style='success'); self.export_png_button = widgets.Button(description="导出 PNG", icon='file-image-o'); self.export_svg_button = widgets.Button(description="导出 SVG", icon='file-image-o'); self.export_pdf_button = widgets.Button(description="导出 PDF", icon='file-pdf-o'); save_box = widgets.VBox([widgets.HTML("<hr><b>保存与导出:</b>"), widgets.HBox([self.filename_input, self.save_button]), widgets.HBox([self.export_png_button, self.export_svg_button, self.export_pdf_button])]); self.controls_layout = widgets.VBox([self.info_label, self.accordion, self.undo_button, save_box]); self.add_point_toggle.observe(self._on_add_mode_toggle, names='value'); self.update_button.on_click(self._on_update_click); self.delete_points_button.on_click(self._on_delete_points_click); self.create_type_button.on_click(self._on_create_type_click); self.rename_button.on_click(self._on_rename_click); self.delete_type_button.on_click(self._on_delete_type_click); self.save_button.on_click(self._on_save_click); self.undo_button.on_click(self._on_undo_click); self.export_png_button.on_click(lambda b: self._export_image('png')); self.export_svg_button.on_click(lambda b: self._export_image('svg')); self.export_pdf_button.on_click(lambda b: self._export_image('pdf'))
+    def _create_widgets(self): self.unique_types_initial = sorted(self.unique_types_initial); self.type_dropdown = widgets.Dropdown(options=self.unique_types_initial, description='目标类型:'); self.update_as_new_input = widgets.Text(value='', placeholder='...或设为新类型', description='', layout=widgets.Layout(width='150px')); self.update_button = widgets.Button(description="更新选中点", icon='pencil', button_style='primary'); self.delete_points_button = widgets.Button(description="删除选中点", icon='trash', button_style='danger'); self.add_point_toggle = widgets.ToggleButton(value=False, description='新增点模式', tooltip='激活后，单击画布可新增点', icon='plus-circle'); edit_points_box = widgets.VBox([widgets.HTML("<b>1. 用套索选择 (按住Shift增选, Ctrl/Cmd减选) 或激活新增点模式</b>"), widgets.HBox([self.type_dropdown, self.update_as_new_input, self.update_button]), widgets.HBox([self.add_point_toggle, self.delete_points_button])]); self.new_type_input = widgets.Text(value='', placeholder='输入新类别名', description='新类别名:'); self.create_type_button = widgets.Button(description="创建", icon='plus', button_style='success'); self.rename_from_dropdown = widgets.Dropdown(options=self.unique_types_initial, description='旧名称:'); self.rename_to_input = widgets.Text(value='', placeholder='输入新名称', description='新名称:'); self.rename_button = widgets.Button(description="重命名", icon='edit'); self.delete_type_dropdown = widgets.Dropdown(options=self.unique_types_initial, description='要删除的类别:'); self.delete_points_checkbox = widgets.Checkbox(value=True, description='同时删除属于该类型的点'); self.delete_type_button = widgets.Button(description="删除类别", icon='trash-o', button_style='danger'); manage_categories_box = widgets.VBox([widgets.HTML("<b>创建新类别:</b>"), widgets.HBox([self.new_type_input, self.create_type_button]), widgets.HTML("<hr style='margin: 10px 0;'>"), widgets.HTML("<b>重命名类别:</b>"), widgets.HBox([self.rename_from_dropdown, self.rename_to_input, self.rename_button]), widgets.HTML("<hr style='margin: 10px 0;'>"), widgets.HTML("<b>删除类别:</b>"), widgets.HBox([self.delete_type_dropdown, self.delete_points_checkbox, self.delete_type_button])]); self.accordion = widgets.Accordion(children=[edit_points_box, manage_categories_box]); self.accordion.set_title(0, '编辑点 (Edit Points)'); self.accordion.set_title(1, '管理类别 (Manage Categories)'); self.undo_button = widgets.Button(description="撤销上一步 (Undo)", icon='undo', button_style='warning', disabled=True); self.redo_button = widgets.Button(description="重做 (Redo)", icon='repeat', button_style='warning', disabled=True); self.info_label = widgets.HTML(value="<b>状态:</b> 欢迎！请用鼠标在图上框选点。"); self.filename_input = widgets.Text(value='corrected_annotations.npz', description='输出文件名:', style={'description_width': 'initial'}); self.save_button = widgets.Button(description="保存 (.npz)", icon='save', button_style='success'); self.export_csv_button = widgets.Button(description="导出 CSV", icon='file-text-o'); self.export_png_button = widgets.Button(description="导出 PNG", icon='file-image-o'); self.export_svg_button = widgets.Button(description="导出 SVG", icon='file-image-o'); self.export_pdf_button = widgets.Button(description="导出 PDF", icon='file-pdf-o'); self.export_tiff_button = widgets.Button(description="导出 TIFF", icon='file-image-o'); self.pixels_per_spot_input = widgets.BoundedIntText(value=4, min=1, max=64, description='像素/spot:', tooltip='PNG/TIFF 中每个 spot 的边长 (像素)', layout=widgets.Layout(width='150px')); save_box = widgets.VBox([widgets.HTML("<hr><b>保存与导出:</b>"), widgets.HBox([self.filename_input, self.save_button, self.export_csv_button]), widgets.HBox([self.pixels_per_spot_input, self.export_png_button, self.export_tiff_button, self.export_svg_button, self.export_pdf_button])]); self.controls_layout = widgets.VBox([self.info_label, self.accordion, widgets.HBox([self.undo_button, self.redo_button]), save_box]); self.add_point_toggle.observe(self._on_add_mode_toggle, names='value'); self.update_button.on_click(self._on_update_click); self.delete_points_button.on_click(self._on_delete_points_click); self.create_type_button.on_click(self._on_create_type_click); self.rename_button.on_click(self._on_rename_click); self.delete_type_button.on_click(self._on_delete_type_click); self.save_button.on_click(self._on_save_click); self.export_csv_button.on_click(self._on_export_csv_click); self.undo_button.on_click(self._on_undo_click); self.redo_button.on_click(self._on_redo_click); self.export_png_button.on_click(lambda b: self._export_image('png')); self.export_tiff_button.on_click(lambda b: self._export_image('tiff')); self.export_svg_button.on_click(lambda b: self._export_image('svg')); self.export_pdf_button.on_click(lambda b: self._export_image('pdf'))
     def _on_add_mode_toggle(self, change):
         if change['new']: self.info_label.value = "<b>状态:</b> <font color='blue'>新增点模式已激活</font>。"; self.lasso.active = False if self.lasso else None; self.fig.canvas.set_cursor(2)
         else: self.info_label.value = "<b>状态:</b> 新增点模式已关闭。"; self.lasso.active = True if self.lasso else None; self.fig.canvas.set_cursor(1)
     def _on_canvas_click(self, event):
         if not self.add_point_toggle.value or event.button != 1 or event.inaxes != self.ax: return
-        x, y = int(round(event.xdata)), int(round(event.ydata))
-        if not self.df[(self.df['grid_x'] == x) & (self.df['grid_y'] == y)].empty: self.info_label.value = f"<b>状态:</b> <font color='orange'>点 ({x}, {y}) 已存在。</font>"; return
-        self._save_state_for_undo()
-        if self.coord_kdtree is not None: _, idx = self.coord_kdtree.query([x, y]); new_barcode = self.master_coords.iloc[idx]['barcode']
+        self._add_point(int(round(event.xdata)), int(round(event.ydata)))
+    @profiled('add_point')
+    def _add_point(self, x: int, y: int):
+        if self.coord_index.contains(x, y): self.info_label.value = f"<b>状态:</b> <font color='orange'>点 ({x}, {y}) 已存在。</font>"; return
+        if self.coord_kdtree is not None: _, idx = self.coord_kdtree.query([x, y]); new_barcode = self.master_barcodes[idx]
         else: new_barcode = f"manual_spot_{y}_{x}"
         target_type = self.type_dropdown.value; color_tuple = tuple(int(c*255) for c in self.color_map.get(target_type, (0.5,0.5,0.5))[:3])
-        new_point = pd.DataFrame([{'barcode': new_barcode, 'grid_x': x, 'grid_y': y, 'cell_type': target_type, 'color': color_tuple}])
-        self.df = pd.concat([self.df, new_point], ignore_index=True); self._update_plot_after_action(f"在 ({x}, {y}) 新增 1 个点。")
-    def _export_image(self, file_format: str): base_filename, _ = os.path.splitext(self.filename_input.value); output_filename = f"{base_filename}.{file_format}"; self.fig.savefig(output_filename, dpi=300, bbox_inches='tight'); self.info_label.value = f"<b>状态:</b> <font color='blue'>图片已成功保存到 {output_filename}</font>"
-    def _on_save_click(self, b):
-        output_filename = self.filename_input.value
+        new_point = compact_annotations(pd.DataFrame([{'barcode': new_barcode, 'grid_x': x, 'grid_y': y, 'cell_type': target_type, 'color': color_tuple}]))
+        self._apply_edit(Edit.add(new_point, self.unique_types_initial, self.unique_types_initial, label='add_point')); self._update_plot_after_action(f"在 ({x}, {y}) 新增 1 个点。")
+    @profiled('export_image')
+    def _export_image(self, file_format: str):
+        """PNG/TIFF 按网格直接栅格化为调色板图像 (与画布缩放无关)，SVG/PDF 为 matplotlib 矢量图"""
+        base_filename, _ = os.path.splitext(self.filename_input.value); output_filename = f"{base_filename}.{file_format}"
+        if file_format in ('png', 'tiff'): export_annotation_map(self.df, output_filename, self.color_map, pixels_per_spot=self.pixels_per_spot_input.value)
+        else: self.fig.savefig(output_filename, dpi=300, bbox_inches='tight')
+        self.info_label.value = f"<b>状态:</b> <font color='blue'>图片已成功保存到 {output_filename}</font>"
+    def _final_df(self) -> pd.DataFrame:
+        """按当前类别重新着色后的注释表 (各类别依次取 tab10 配色，Unassigned 为灰色)"""
+        final_df = self.df.copy(); current_types = sorted(list(final_df['cell_type'].unique())); palette = plt.get_cmap('tab10')
+        rgb_table = np.array([(204, 204, 204) if ctype == 'Unassigned' else tuple(int(c*255) for c in palette(i % 10)[:3]) for i, ctype in enumerate(current_types)], dtype=np.uint8).reshape(-1, 3)
+        colors = rgb_table[pd.Categorical(final_df['cell_type'], categories=current_types).codes]
+        for i, col in enumerate(COLOR_COLUMNS): final_df[col] = colors[:, i]
+        return final_df
+    @profiled('save')
+    def _on_save_click(self, b): self._save(self.filename_input.value, 'npz')
+    @profiled('export_csv')
+    def _on_export_csv_click(self, b): self._save(self.filename_input.value, 'csv')
+    def _save(self, output_filename: str, file_format: str):
+        """npz 为二进制会话格式 (可在“加载已有标注”中直接打开)，csv 为兼容旧版的导出格式"""
         try:
-            final_df = self.df.copy(); current_types = sorted(list(final_df['cell_type'].unique())); palette = plt.get_cmap('tab10'); self.color_map = {ctype: palette(i % 10) for i, ctype in enumerate(current_types)}; self.color_map['Unassigned'] = (0.8, 0.8, 0.8, 1.0)
-            type_to_rgb_map = {ctype: tuple(int(c*255) for c in color[:3]) for ctype, color in self.color_map.items()}; final_df['color'] = final_df['cell_type'].map(type_to_rgb_map).fillna(str((0,0,0)))
-            if not output_filename.endswith('.csv'): base, _ = os.path.splitext(output_filename); output_filename = base + '.csv'
-            final_df.to_csv(output_filename, index=False, columns=['barcode', 'grid_x', 'grid_y', 'cell_type', 'color']); self.info_label.value = f"<b>状态:</b> <font color='green'>成功保存到 {output_filename}</font>"
+            base, ext = os.path.splitext(output_filename)
+            if ext.lower() != '.' + file_format: output_filename = base + '.' + file_format
+            save_annotations(self._final_df(), output_filename, file_format); self.info_label.value = f"<b>状态:</b> <font color='green'>成功保存到 {output_filename}</font>"
         except Exception as e: self.info_label.value = f"<b>状态:</b> <font color='red'>保存失败: {e}</font>"
-    def _save_state_for_undo(self): self.df_history.append(self.df.copy()); self.types_history.append(self.unique_types_initial.copy()); self.undo_button.disabled = False
-    def _update_plot(self):
-        self.ax.clear(); unique_types_filtered = sorted([t for t in self.unique_types_initial if t != 'Unassigned']); palette = plt.get_cmap('tab10'); self.color_map = {ctype: palette(i % 10) for i, ctype in enumerate(unique_types_filtered)}; self.color_map['Unassigned'] = (0.8, 0.8, 0.8, 1.0)
-        for cell_type, color in self.color_map.items():
-            subset = self.df[self.df['cell_type'] == cell_type]
-            if not subset.empty: self.ax.scatter(subset['grid_x'], subset['grid_y'], c=[color], label=cell_type, s=50)
-        self.ax.set_title('Interactive Cell Type Annotation'); self.ax.set_aspect('equal', adjustable='box'); self.ax.invert_yaxis(); self.ax.legend(title='Cell Types', bbox_to_anchor=(1.05, 1), loc='upper left'); self.ax.grid(True, linestyle='--', alpha=0.5); self.fig.tight_layout(rect=[0, 0, 0.85, 1]); self.lasso = LassoSelector(self.ax, self._on_select); self.fig.canvas.draw_idle()
+    def _apply_edit(self, edit):
+        """通过撤销日志执行一个编辑操作并同步类别列表与撤销/重做按钮"""
+        self.df = self.history.do(edit, self.df); self._sync_coord_index(edit); self.unique_types_initial = list(edit.types_after); self._refresh_history_buttons()
+    def _sync_coord_index(self, edit, undo=False):
+        """按编辑操作增量更新坐标索引 (只有新增/删除点会改变坐标与行号)"""
+        if edit.kind == 'add':
+            if undo: self.coord_index.delete(np.arange(len(self.coord_index) - len(edit.rows), len(self.coord_index)))
+            else: self.coord_index.add(edit.rows['grid_x'].to_numpy(), edit.rows['grid_y'].to_numpy())
+        elif edit.kind == 'delete':
+            if undo: self.coord_index.insert(edit.indices, edit.rows['grid_x'].to_numpy(), edit.rows['grid_y'].to_numpy())
+            else: self.coord_index.delete(edit.indices)
+    def _refresh_history_buttons(self): self.undo_button.disabled = not self.history.can_undo; self.redo_button.disabled = not self.history.can_redo
+    def _init_plot(self):
+        """创建持久的绘图对象：每个类别一个散点集合 + 选区高亮层；之后的编辑只更新它们的坐标/颜色，不再清空坐标轴"""
+        self.color_map = {}; self.type_artists = {}; self._legend_key = None; self._background = None; self._n_points = len(self.df); self.spatial_index = GridIndex(np.empty((0, 2)))
+        self._use_blit = bool(getattr(self.fig.canvas, 'supports_blit', False))
+        # 高亮层为 animated 艺术家：选区变化时通过 blit 只重绘这一层
+        self.highlight_plot = self.ax.scatter(np.empty(0), np.empty(0), facecolors='none', edgecolors='black', s=80, linewidth=1.5, label='_nolegend_', animated=self._use_blit, zorder=3)
+        self.ax.set_title('Interactive Cell Type Annotation'); self.ax.set_aspect('equal', adjustable='box'); self.ax.invert_yaxis(); self.ax.grid(True, linestyle='--', alpha=0.5); self.fig.tight_layout(rect=[0, 0, 0.85, 1]); self.lasso = LassoSelector(self.ax, self._on_select)
+    def _build_color_map(self):
+        unique_types_filtered = sorted([t for t in self.unique_types_initial if t != 'Unassigned']); palette = plt.get_cmap('tab10'); color_map = {ctype: palette(i % 10) for i, ctype in enumerate(unique_types_filtered)}; color_map['Unassigned'] = (0.8, 0.8, 0.8, 1.0)
+        return color_map
+    @profiled('render')
+    def _update_plot(self, changed_types=None):
+        """
+        增量刷新散点图。changed_types 为 None 时重新分配全部点的坐标并重设视野；
+        否则只更新这些类别的散点坐标。配色变化时只改颜色，图例仅在类别集合或配色变化时重建。
+        (每个类别保持单色集合，以保留 matplotlib 对单色散点的快速绘制路径)
+        """
+        if len(self.df) != self._n_points: self.selected_indices = np.array([], dtype=int); self._n_points = len(self.df)
+        color_map = self._build_color_map(); palette_changed = color_map != self.color_map; self.color_map = color_map
+        for cell_type in [t for t in self.type_artists if t not in self.color_map]: self.type_artists.pop(cell_type).remove()
+        for order, (cell_type, color) in enumerate(self.color_map.items()):
+            if cell_type not in self.type_artists: self.type_artists[cell_type] = self.ax.scatter(np.empty(0), np.empty(0), c=[color], label=cell_type, s=50)
+            artist = self.type_artists[cell_type]; artist.set_zorder(1 + order / (len(self.color_map) + 1))
+            if palette_changed: artist.set_facecolor(color); artist.set_edgecolor(color)
+        coords = self.df[['grid_x', 'grid_y']].to_numpy(dtype=float).reshape(-1, 2)
+        if changed_types is None:
+            codes = pd.Categorical(self.df['cell_type'], categories=list(self.color_map)).codes
+            order = np.argsort(codes, kind='stable'); bounds = np.searchsorted(codes[order], np.arange(len(self.color_map) + 1))
+            for k, cell_type in enumerate(self.color_map): self.type_artists[cell_type].set_offsets(coords[order[bounds[k]:bounds[k + 1]]])
+            self.spatial_index = GridIndex(coords)  # 只有全量刷新时点的坐标/行号才可能变化
+            self.ax.ignore_existing_data_limits = True
+            if len(coords): self.ax.update_datalim(coords)
+            self.ax.autoscale_view()
+        else:
+            for cell_type in changed_types:
+                if cell_type in self.type_artists: self.type_artists[cell_type].set_offsets(coords[(self.df['cell_type'] == cell_type).to_numpy()])
+        present = set(self.df['cell_type'].unique()); legend_key = tuple((t, c) for t, c in self.color_map.items() if t in present)
+        if legend_key != self._legend_key:
+            handles = [self.type_artists[t] for t, _ in legend_key]
+            if handles: self.ax.legend(handles=handles, title='Cell Types', bbox_to_anchor=(1.05, 1), loc='upper left')
+            elif self.ax.get_legend(): self.ax.get_legend().remove()
+            self._legend_key = legend_key
+        self._highlight_selection(redraw=False); self.fig.canvas.draw_idle()
+    def _on_draw(self, event):
+        # 每次完整重绘后保存不含高亮层的背景，供选区变化时 blit (savefig 导出矢量图时画布被临时替换，跳过)
+        if self._use_blit and getattr(event.canvas, 'supports_blit', False): self._background = self.fig.canvas.copy_from_bbox(self.ax.bbox); self.ax.draw_artist(self.highlight_plot)
     def _update_dropdowns(self): sorted_types = sorted(self.unique_types_initial); self.type_dropdown.options = sorted_types; self.rename_from_dropdown.options = sorted_types; self.delete_type_dropdown.options = sorted_types
     def _on_key_press(self, event):
         if event.key == 'shift': self.shift_pressed = True
@@ -97,48 +185,68 @@ class CellTypeAnnotator:
     def _on_key_release(self, event):
         if event.key == 'shift': self.shift_pressed = False
         if event.key in ['control', 'super', 'cmd']: self.ctrl_pressed = False
+    @profiled('lasso')
     def _on_select(self, vertices):
-        path = Path(vertices); points = self.df[['grid_x', 'grid_y']].values; newly_selected_indices = np.nonzero(path.contains_points(points))[0]
-        current_selection_set = set(self.selected_indices); new_selection_set = set(newly_selected_indices)
-        if self.shift_pressed: updated_selection_set = current_selection_set.union(new_selection_set)
-        elif self.ctrl_pressed: updated_selection_set = current_selection_set.difference(new_selection_set)
-        else: updated_selection_set = new_selection_set
-        self.selected_indices = np.array(list(updated_selection_set), dtype=int)
-        self._highlight_selection(); self.info_label.value = f"<b>状态:</b> 已选中 {len(self.selected_indices)} 个点。"
-    def _highlight_selection(self):
-        if self.highlight_plot: self.highlight_plot.remove()
-        if self.selected_indices.size > 0:
-            selected_data = self.df.iloc[self.selected_indices]
-            self.highlight_plot = self.ax.scatter(selected_data['grid_x'], selected_data['grid_y'], facecolors='none', edgecolors='black', s=80, linewidth=1.5, label='_nolegend_')
-        else: self.highlight_plot = None
-        self.fig.canvas.draw_idle()
-    def _update_plot_after_action(self, msg): self.selected_indices = np.array([], dtype=int); self._update_plot(); self.info_label.value = f"<b>状态:</b> <font color='green'>{msg}</font> {len(self.df)} 个点剩余。"
+        inside = self.spatial_index.contains(vertices)  # 只对套索外接矩形内的点做精确判断
+        if self.shift_pressed: self.selected_mask |= inside
+        elif self.ctrl_pressed: self.selected_mask &= ~inside
+        else: self.selected_mask = inside
+        self._highlight_selection(); self.info_label.value = f"<b>状态:</b> 已选中 {int(self.selected_mask.sum())} 个点。"
+    def _highlight_selection(self, redraw=True):
+        self.highlight_plot.set_offsets(self.spatial_index.coords[self.selected_mask])
+        # 空选区时隐藏高亮层：可见的 animated 艺术家会让 LassoSelector 在每次重绘时额外完整重绘一遍
+        self.highlight_plot.set_visible(bool(self.selected_mask.any()))
+        if not redraw: return
+        if self._use_blit and self._background is not None:
+            self.fig.canvas.restore_region(self._background); self.ax.draw_artist(self.highlight_plot); self.fig.canvas.blit(self.ax.bbox)
+        else: self.fig.canvas.draw_idle()
+    def _update_plot_after_action(self, msg, changed_types=None): self.selected_indices = np.array([], dtype=int); self._update_plot(changed_types); self.info_label.value = f"<b>状态:</b> <font color='green'>{msg}</font> {len(self.df)} 个点剩余。"
+    @profiled('relabel')
     def _on_update_click(self, b):
-        if len(self.selected_indices) == 0: self.info_label.value = "<b>状态:</b> <font color='red'>未选中任何点。</font>"; return
-        self._save_state_for_undo()
+        if not self.selected_mask.any(): self.info_label.value = "<b>状态:</b> <font color='red'>未选中任何点。</font>"; return
+        types_before = list(self.unique_types_initial); types_after = list(types_before)
         new_type_name = self.update_as_new_input.value.strip()
         if new_type_name:
             target_type = new_type_name
-            if target_type not in self.unique_types_initial: self.unique_types_initial.append(target_type); self._update_dropdowns()
+            if target_type not in types_after: types_after.append(target_type)
         else: target_type = self.type_dropdown.value
-        self.df.iloc[self.selected_indices, self.df.columns.get_loc('cell_type')] = target_type; self.update_as_new_input.value = ''; self._update_plot_after_action("更新成功！")
-    def _on_delete_points_click(self, b): self._save_state_for_undo(); num_deleted = len(self.selected_indices); self.df.drop(self.df.index[self.selected_indices], inplace=True); self.df.reset_index(drop=True, inplace=True); self._update_plot_after_action(f"删除了 {num_deleted} 个点！")
-    def _on_create_type_click(self, b): new_name = self.new_type_input.value.strip(); self._save_state_for_undo(); self.unique_types_initial.append(new_name); self._update_dropdowns(); self._update_plot(); self.info_label.value = f"<b>状态:</b> <font color='green'>成功创建新类别: '{new_name}'</font>"; self.new_type_input.value = ''
-    def _on_rename_click(self, b): old_name = self.rename_from_dropdown.value; new_name = self.rename_to_input.value.strip(); self._save_state_for_undo(); self.df.loc[self.df['cell_type'] == old_name, 'cell_type'] = new_name; self.unique_types_initial = [new_name if t == old_name else t for t in self.unique_types_initial]; self._update_dropdowns(); self._update_plot(); self.info_label.value = f"<b>状态:</b> <font color='green'>成功将 '{old_name}' 重命名为 '{new_name}'。</font>"; self.rename_to_input.value = ''
+        selected = self.selected_indices; changed_types = set(self.df['cell_type'].iloc[selected]) | {target_type}
+        self._apply_edit(Edit.relabel(self.df, selected, target_type, types_before, types_after, label='update'))
+        if types_after != types_before: self._update_dropdowns()
+        self.update_as_new_input.value = ''; self._update_plot_after_action("更新成功！", changed_types)
+    @profiled('delete_points')
+    def _on_delete_points_click(self, b): selected = self.selected_indices; num_deleted = len(selected); self._apply_edit(Edit.delete(self.df, selected, self.unique_types_initial, self.unique_types_initial, label='delete_points')); self._update_plot_after_action(f"删除了 {num_deleted} 个点！")
+    @profiled('create_type')
+    def _on_create_type_click(self, b): new_name = self.new_type_input.value.strip(); self._apply_edit(Edit.types(self.unique_types_initial, self.unique_types_initial + [new_name], label='create_type')); self._update_dropdowns(); self._update_plot(); self.info_label.value = f"<b>状态:</b> <font color='green'>成功创建新类别: '{new_name}'</font>"; self.new_type_input.value = ''
+    @profiled('rename_type')
+    def _on_rename_click(self, b):
+        old_name = self.rename_from_dropdown.value; new_name = self.rename_to_input.value.strip()
+        types_after = [new_name if t == old_name else t for t in self.unique_types_initial]
+        self._apply_edit(Edit.relabel(self.df, np.flatnonzero((self.df['cell_type'] == old_name).to_numpy()), new_name, self.unique_types_initial, types_after, label='rename_type'))
+        self._update_dropdowns(); self._update_plot({old_name, new_name}); self.info_label.value = f"<b>状态:</b> <font color='green'>成功将 '{old_name}' 重命名为 '{new_name}'。</font>"; self.rename_to_input.value = ''
+    @profiled('delete_type')
     def _on_delete_type_click(self, b):
         type_to_delete = self.delete_type_dropdown.value
         if type_to_delete is None: self.info_label.value = "<b>状态:</b> <font color='red'>没有可删除的类别。</font>"; return
-        self._save_state_for_undo()
+        type_indices = np.flatnonzero((self.df['cell_type'] == type_to_delete).to_numpy()); types_after = [t for t in self.unique_types_initial if t != type_to_delete]
         if self.delete_points_checkbox.value:
-            num_deleted = len(self.df[self.df['cell_type'] == type_to_delete]); self.df = self.df[self.df['cell_type'] != type_to_delete].reset_index(drop=True); self.info_label.value = f"<b>状态:</b> <font color='green'>已删除类别 '{type_to_delete}' 及其包含的 {num_deleted} 个点。</font>"
+            self._apply_edit(Edit.delete(self.df, type_indices, self.unique_types_initial, types_after, label='delete_type')); self.info_label.value = f"<b>状态:</b> <font color='green'>已删除类别 '{type_to_delete}' 及其包含的 {len(type_indices)} 个点。</font>"
         else:
-            self.df.loc[self.df['cell_type'] == type_to_delete, 'cell_type'] = 'Unassigned'
-            if 'Unassigned' not in self.unique_types_initial: self.unique_types_initial.append('Unassigned')
+            if 'Unassigned' not in types_after: types_after.append('Unassigned')
+            self._apply_edit(Edit.relabel(self.df, type_indices, 'Unassigned', self.unique_types_initial, types_after, label='delete_type'))
             self.info_label.value = f"<b>状态:</b> <font color='green'>已将类别 '{type_to_delete}' 的所有点重置为 'Unassigned'。</font>"
-        if type_to_delete in self.unique_types_initial: self.unique_types_initial.remove(type_to_delete)
         self._update_dropdowns(); self._update_plot()
+    @profiled('undo')
     def _on_undo_click(self, b):
-        if len(self.df_history) > 1:
-            self.df_history.pop(); self.types_history.pop(); self.df = self.df_history[-1].copy(); self.unique_types_initial = self.types_history[-1].copy(); self._update_dropdowns(); self._update_plot(); self.info_label.value = "<b>状态:</b> 操作已撤销。"
+        edit = self.history.undo_stack[-1] if self.history.can_undo else None; result = self.history.undo(self.df)
+        if result is not None:
+            self.df, self.unique_types_initial = result; self._sync_coord_index(edit, undo=True); self._update_dropdowns(); self._update_plot(); self.info_label.value = "<b>状态:</b> 操作已撤销。"
         else: self.info_label.value = "<b>状态:</b> 已是最初始状态，无法再撤销。"
-        if len(self.df_history) <= 1: self.undo_button.disabled = True
+        self._refresh_history_buttons()
+    @profiled('redo')
+    def _on_redo_click(self, b):
+        edit = self.history.redo_stack[-1] if self.history.can_redo else None; result = self.history.redo(self.df)
+        if result is not None:
+            self.df, self.unique_types_initial = result; self._sync_coord_index(edit); self._update_dropdowns(); self._update_plot(); self.info_label.value = "<b>状态:</b> 操作已重做。"
+        else: self.info_label.value = "<b>状态:</b> 没有可重做的操作。"
+        self._refresh_history_buttons()
@@ -0,0 +1,137 @@
+# annotator/export.py
+
+import os
+import numbers
+import numpy as np
+import pandas as pd
+from PIL import Image, ImageDraw, ImageFont
+from matplotlib.colors import to_rgb
+from .clustering import _pack_rgb
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+UNKNOWN_COLOR = (128, 128, 128)
+TEXT_COLOR = (0, 0, 0)
+LEGEND_ROW_HEIGHT = 20
+
+def _to_rgb255(color):
+    """颜色统一为 0-255 的 (r, g, b)：各分量均为整数时视为 0-255，其余 (如 (0, 0, 1.0)、颜色名) 按 matplotlib 颜色规范解析"""
+    if not isinstance(color, str) and all(isinstance(c, numbers.Integral) and not isinstance(c, bool) for c in tuple(color)[:3]): return tuple(int(c) for c in tuple(color)[:3])
+    return tuple(int(c * 255) for c in to_rgb(color))
+
+class AnnotationRaster:
+    """
+    把注释表按网格直接绘制为调色板图像：每个 spot 为 pixels_per_spot x pixels_per_spot 的色块，右侧可附带图例条。
+    像素以调色板编号保存 (类别数不超过 253 时为 uint8)，写 PNG/TIFF 时数据量只有 RGB 的三分之一；
+    任意像素区域都可按需生成，分块导出时内存只与块大小有关。
+    """
+    def __init__(self, df: pd.DataFrame, colors: dict, pixels_per_spot: int = 4, legend: bool = True, background_color=(255, 255, 255)):
+        if pixels_per_spot < 1: raise ValueError(f"pixels_per_spot 必须 >= 1，当前为 {pixels_per_spot!r}")
+        self.pixels_per_spot = int(pixels_per_spot); colors = {name: _to_rgb255(c) for name, c in colors.items()}
+        # 调色板：各类别颜色、未知类别 (灰)、无 spot 的背景、图例文字
+        n = len(colors); self.background_index = n + 1; self.text_index = n + 2
+        self.palette = np.array(list(colors.values()) + [UNKNOWN_COLOR, tuple(background_color), TEXT_COLOR], dtype=np.uint8).reshape(-1, 3)
+        self.dtype = np.uint8 if len(self.palette) <= 256 else np.uint16
+        xs, ys = df['grid_x'].to_numpy(dtype=np.int64), df['grid_y'].to_numpy(dtype=np.int64)
+        self.origin = (int(xs.min()), int(ys.min())) if len(df) else (0, 0)
+        grid_w = int(xs.max()) - self.origin[0] + 1 if len(df) else 1; grid_h = int(ys.max()) - self.origin[1] + 1 if len(df) else 1
+        self.labels = np.full((grid_h, grid_w), self.background_index, dtype=self.dtype)
+        codes = pd.Categorical(df['cell_type'], categories=list(colors)).codes.astype(np.int64); codes[codes < 0] = n
+        self.labels[ys - self.origin[1], xs - self.origin[0]] = codes
+        self.map_shape = (grid_h * self.pixels_per_spot, grid_w * self.pixels_per_spot)
+        present = set(df['cell_type'].unique())
+        entries = [(name, colors[name]) for name in colors if name in present]
+        self.legend = self._legend_strip(entries) if legend and entries else np.zeros((0, 0), dtype=self.dtype)
+        self.shape = (max(self.map_shape[0], self.legend.shape[0]), self.map_shape[1] + self.legend.shape[1])
+
+    def _legend_strip(self, entries) -> np.ndarray:
+        font = ImageFont.load_default(); swatch = LEGEND_ROW_HEIGHT - 6
+        probe = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+        text_w = max(probe.textbbox((0, 0), name, font=font)[2] for name, _ in entries)
+        strip = Image.new('RGB', (swatch + text_w + 24, LEGEND_ROW_HEIGHT * len(entries) + 6), tuple(int(c) for c in self.palette[self.background_index]))
+        draw = ImageDraw.Draw(strip); draw.fontmode = '1'  # 关闭抗锯齿，图例只用到调色板中已有的颜色
+        for i, (name, color) in enumerate(entries):
+            top = 6 + i * LEGEND_ROW_HEIGHT
+            draw.rectangle([8, top, 8 + swatch, top + swatch], fill=color, outline=TEXT_COLOR); draw.text((16 + swatch, top + 1), name, fill=TEXT_COLOR, font=font)
+        # RGB → 调色板编号 (颜色重复时取第一个编号)
+        keys = _pack_rgb(self.palette); order = np.argsort(keys, kind='stable'); pixels = _pack_rgb(np.asarray(strip))
+        pos = np.minimum(np.searchsorted(keys[order], pixels), len(keys) - 1)
+        return np.where(keys[order][pos] == pixels, order[pos], self.text_index).astype(self.dtype)
+
+    def render_indices(self) -> np.ndarray:
+        """整幅图像的调色板编号 (H, W)；色块放大为一次广播复制"""
+        p = self.pixels_per_spot; grid_h, grid_w = self.labels.shape
+        image = np.full(self.shape, self.background_index, dtype=self.dtype)
+        image[:self.map_shape[0], :self.map_shape[1]] = np.broadcast_to(self.labels[:, None, :, None], (grid_h, p, grid_w, p)).reshape(self.map_shape)
+        if self.legend.size: image[:self.legend.shape[0], self.map_shape[1]:] = self.legend
+        return image
+
+    def render(self) -> np.ndarray:
+        """整幅 RGB 图像 (H, W, 3)"""
+        return self.palette[self.render_indices()]
+
+    def render_pixels(self, rows, cols) -> np.ndarray:
+        """按整幅图像的像素行号/列号取调色板编号子图 (用于分块与金字塔缩略层，缩略层为最近邻采样)"""
+        rows, cols = np.asarray(rows), np.asarray(cols); p = self.pixels_per_spot
+        tile = np.full((len(rows), len(cols)), self.background_index, dtype=self.dtype)
+        in_map_r = rows < self.map_shape[0]; in_map_c = cols < self.map_shape[1]
+        if in_map_r.any() and in_map_c.any(): tile[np.ix_(in_map_r, in_map_c)] = self.labels[np.ix_(rows[in_map_r] // p, cols[in_map_c] // p)]
+        if self.legend.size:
+            in_leg_r = rows < self.legend.shape[0]; in_leg_c = ~in_map_c
+            if in_leg_r.any() and in_leg_c.any(): tile[np.ix_(in_leg_r, in_leg_c)] = self.legend[np.ix_(rows[in_leg_r], cols[in_leg_c] - self.map_shape[1])]
+        return tile
+
+    def level_shape(self, level: int):
+        step = 2 ** level
+        return (-(-self.shape[0] // step), -(-self.shape[1] // step))
+
+    def iter_tiles(self, level: int = 0, tile_size: int = 256):
+        """按行优先顺序生成第 level 层 (尺寸缩小 2**level 倍) 的 tile_size x tile_size 编号分块，边缘块以背景补齐"""
+        step = 2 ** level; height, width = self.level_shape(level)
+        for y0 in range(0, height, tile_size):
+            for x0 in range(0, width, tile_size):
+                rows = np.arange(y0, min(y0 + tile_size, height)) * step; cols = np.arange(x0, min(x0 + tile_size, width)) * step
+                tile = np.full((tile_size, tile_size), self.background_index, dtype=self.dtype)
+                tile[:len(rows), :len(cols)] = self.render_pixels(rows, cols)
+                yield tile
+
+    def to_image(self) -> Image.Image:
+        """PIL 图像：类别数允许时为调色板 ('P') 模式，否则为 RGB"""
+        if self.dtype != np.uint8: return Image.fromarray(self.render())
+        height, width = self.shape; image = Image.frombytes('P', (width, height), self.render_indices().tobytes())
+        image.putpalette(self.palette.ravel().tolist())
+        return image
+
+def export_annotation_map(df: pd.DataFrame, path: str, colors: dict, pixels_per_spot: int = 4, legend: bool = True, background_color=(255, 255, 255),
+                          tiled: bool = False, tile_size: int = 256, pyramid_levels: int = None, compression=None) -> str:
+    """
+    将注释表直接导出为 PNG / TIFF 栅格图 (不经过 matplotlib)。colors 为 {类别: 颜色}，颜色可以是 0-1 浮点或 0-255 整数。
+    tiled=True 时写出分块 (可含金字塔缩略层) 的 BigTIFF，逐块生成像素，需要 tifffile；
+    pyramid_levels 为 None 时自动添加缩略层直到最长边不超过一个分块。
+    """
+    raster = AnnotationRaster(df, colors, pixels_per_spot=pixels_per_spot, legend=legend, background_color=background_color)
+    ext = os.path.splitext(path)[1].lower()
+    if tiled:
+        if ext not in ('.tif', '.tiff'): raise ValueError("分块/金字塔模式只支持 .tif / .tiff 文件。")
+        if tifffile is None: raise ImportError("分块 TIFF 导出需要安装 tifffile。")
+        if pyramid_levels is None:
+            pyramid_levels = 0
+            while max(raster.level_shape(pyramid_levels)) > tile_size: pyramid_levels += 1
+        if raster.dtype == np.uint8:
+            colormap = np.zeros((3, 256), dtype=np.uint16); colormap[:, :len(raster.palette)] = raster.palette.T.astype(np.uint16) * 257
+            options = {'photometric': 'palette', 'colormap': colormap, 'dtype': np.uint8}; tiles = raster.iter_tiles; shape = lambda level: raster.level_shape(level)
+        else:
+            options = {'photometric': 'rgb', 'dtype': np.uint8}; shape = lambda level: raster.level_shape(level) + (3,)
+            tiles = lambda level, size: (raster.palette[tile] for tile in raster.iter_tiles(level, size))
+        with tifffile.TiffWriter(path, bigtiff=True) as tif:
+            tif.write(tiles(0, tile_size), shape=shape(0), tile=(tile_size, tile_size), compression=compression, subifds=pyramid_levels, **options)
+            for level in range(1, pyramid_levels + 1): tif.write(tiles(level, tile_size), shape=shape(level), tile=(tile_size, tile_size), compression=compression, subfiletype=1, **options)
+        return path
+    image = raster.to_image()
+    if ext == '.png': image.save(path, compress_level=1)  # 标注图大片同色，低压缩级别已足够小且快得多
+    elif ext in ('.tif', '.tiff'): image.save(path, compression=compression or 'tiff_deflate')
+    else: raise ValueError(f"不支持的栅格导出格式: {ext!r} (可选 .png / .tif / .tiff)")
+    return path
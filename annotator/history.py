@@ -0,0 +1,178 @@
+# annotator/history.py
+
+import os
+import pickle
+from collections import deque
+import numpy as np
+import pandas as pd
+
+def _concat_rows(df: pd.DataFrame, rows: pd.DataFrame) -> pd.DataFrame:
+    """追加行并保持 df 的列类型 (类别型列合并类别，避免 concat 退化为 object 列)"""
+    rows = rows.copy()
+    for col in df.columns:
+        if col not in rows.columns: continue
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            categories = df[col].cat.categories.union(pd.Index(pd.unique(rows[col].astype(str).to_numpy())), sort=False)
+            df = df.assign(**{col: df[col].cat.set_categories(categories)}); rows[col] = pd.Categorical(rows[col].astype(str).to_numpy(), categories=categories)
+        elif not rows[col].isna().any(): rows[col] = rows[col].astype(df[col].dtype)
+    return pd.concat([df, rows], ignore_index=True)
+
+def _set_types(df: pd.DataFrame, indices, values) -> pd.DataFrame:
+    # 类别型 cell_type 需先登记新类别才能赋值
+    if isinstance(df['cell_type'].dtype, pd.CategoricalDtype):
+        missing = [v for v in pd.unique(np.asarray(values, dtype=object).ravel()) if v not in df['cell_type'].cat.categories]
+        if missing: df['cell_type'] = df['cell_type'].cat.add_categories(missing)
+    df.iloc[indices, df.columns.get_loc('cell_type')] = values
+    return df
+
+class Edit:
+    """
+    一次可逆的编辑操作，只记录受影响的行号及其旧/新值，而不是整表快照。
+    kind 取值: 'relabel' (改类型/重命名/将类别置为 Unassigned)、'delete' (删除点)、'add' (新增点)、'types' (仅类别列表变化)。
+    """
+    def __init__(self, kind, label, types_before, types_after, indices=None, old_values=None, new_value=None, rows=None):
+        self.kind = kind; self.label = label
+        self.types_before = list(types_before); self.types_after = list(types_after)
+        self.indices = None if indices is None else np.asarray(indices, dtype=np.int64)
+        self.old_values = old_values; self.new_value = new_value; self.rows = rows; self.categories_before = None
+
+    @classmethod
+    def relabel(cls, df, indices, new_type, types_before, types_after, label='relabel'):
+        indices = np.asarray(indices, dtype=np.int64)
+        return cls('relabel', label, types_before, types_after, indices=indices, old_values=df['cell_type'].iloc[indices].to_numpy(dtype=object), new_value=new_type)
+
+    @classmethod
+    def delete(cls, df, indices, types_before, types_after, label='delete'):
+        indices = np.unique(np.asarray(indices, dtype=np.int64))
+        return cls('delete', label, types_before, types_after, indices=indices, rows=df.iloc[indices].copy())
+
+    @classmethod
+    def add(cls, rows, types_before, types_after, label='add'):
+        return cls('add', label, types_before, types_after, rows=rows.reset_index(drop=True))
+
+    @classmethod
+    def types(cls, types_before, types_after, label='types'):
+        return cls('types', label, types_before, types_after)
+
+    @property
+    def nbytes(self) -> int:
+        """粗略估计该操作占用的内存，用于历史记录的内存上限 (操作创建后不再变化，只计算一次)"""
+        if getattr(self, '_nbytes', None) is None:
+            size = 0 if self.indices is None else self.indices.nbytes
+            if self.old_values is not None: size += int(pd.Series(self.old_values).memory_usage(deep=True))
+            if self.rows is not None: size += int(self.rows.memory_usage(deep=True).sum())
+            self._nbytes = size
+        return self._nbytes
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        # 记录执行前的类别集合，撤销时据此还原 (操作可能登记了新类别)
+        if isinstance(df['cell_type'].dtype, pd.CategoricalDtype): self.categories_before = list(df['cell_type'].cat.categories)
+        if self.kind == 'relabel':
+            return _set_types(df, self.indices, self.new_value) if len(self.indices) else df
+        if self.kind == 'delete': return df.drop(df.index[self.indices]).reset_index(drop=True)
+        if self.kind == 'add': return _concat_rows(df, self.rows)
+        return df
+
+    def revert(self, df: pd.DataFrame) -> pd.DataFrame:
+        df = self._revert(df)
+        if self.categories_before is not None and isinstance(df['cell_type'].dtype, pd.CategoricalDtype): df['cell_type'] = df['cell_type'].cat.set_categories(self.categories_before)
+        return df
+
+    def _revert(self, df: pd.DataFrame) -> pd.DataFrame:
+        if self.kind == 'relabel':
+            return _set_types(df, self.indices, self.old_values) if len(self.indices) else df
+        if self.kind == 'delete':
+            # 把被删除的行按原行号插回去
+            removed = np.zeros(len(df) + len(self.indices), dtype=bool); removed[self.indices] = True
+            positions = np.concatenate([np.flatnonzero(~removed), self.indices])
+            return _concat_rows(df, self.rows).iloc[np.argsort(positions, kind='stable')].reset_index(drop=True)
+        if self.kind == 'add': return df.iloc[:len(df) - len(self.rows)].reset_index(drop=True)
+        return df
+
+class EditHistory:
+    """
+    基于增量的撤销/重做日志。
+    - max_depth / max_bytes 限制可撤销的步数与占用内存，超出时丢弃最早的操作；
+    - 指定 journal_path 时，每个操作都追加写入磁盘日志，并每隔 checkpoint_every 步写入一次完整快照
+      (同时压缩日志)，内核重启后可用 EditHistory.replay(journal_path) 恢复会话。
+      journal_path 已有内容时默认拒绝覆盖 (以免新会话抹掉待恢复的日志)，overwrite_journal=True 时先把旧日志改名为 .bak 再开始新日志。
+    """
+    def __init__(self, df: pd.DataFrame, types, max_depth: int = 20, max_bytes: int = None, checkpoint_every: int = 50, journal_path: str = None, overwrite_journal: bool = False):
+        self.max_depth = max_depth; self.max_bytes = max_bytes; self.checkpoint_every = checkpoint_every; self.journal_path = journal_path
+        self.undo_stack = deque(); self.redo_stack = []; self._since_checkpoint = 0
+        if journal_path and os.path.exists(journal_path) and os.path.getsize(journal_path):
+            if not overwrite_journal: raise FileExistsError(f"撤销日志 {journal_path} 已存在：恢复会话请使用 EditHistory.replay / CellTypeAnnotator.from_journal，或传入 overwrite_journal=True 开始新日志。")
+            os.replace(journal_path, journal_path + '.bak')
+        if journal_path: self.checkpoint(df, types)
+
+    @property
+    def can_undo(self): return len(self.undo_stack) > 0
+    @property
+    def can_redo(self): return len(self.redo_stack) > 0
+
+    def do(self, edit: Edit, df: pd.DataFrame) -> pd.DataFrame:
+        """执行并记录一个操作 (清空重做栈)，返回新的 DataFrame"""
+        df = edit.apply(df)
+        self.undo_stack.append(edit); self.redo_stack.clear(); self._trim()
+        self._journal(('do', edit), df, edit.types_after)
+        return df
+
+    def undo(self, df: pd.DataFrame):
+        """撤销最近一次操作，返回 (DataFrame, 类别列表)；无可撤销操作时返回 None"""
+        if not self.undo_stack: return None
+        edit = self.undo_stack.pop(); df = edit.revert(df); self.redo_stack.append(edit)
+        self._journal(('undo',), df, edit.types_before)
+        return df, list(edit.types_before)
+
+    def redo(self, df: pd.DataFrame):
+        """重做最近一次被撤销的操作，返回 (DataFrame, 类别列表)；无可重做操作时返回 None"""
+        if not self.redo_stack: return None
+        edit = self.redo_stack.pop(); df = edit.apply(df); self.undo_stack.append(edit); self._trim()
+        self._journal(('redo',), df, edit.types_after)
+        return df, list(edit.types_after)
+
+    def _trim(self):
+        while self.max_depth is not None and len(self.undo_stack) > self.max_depth: self.undo_stack.popleft()
+        if self.max_bytes is not None:
+            while len(self.undo_stack) > 1 and sum(e.nbytes for e in self.undo_stack) + sum(e.nbytes for e in self.redo_stack) > self.max_bytes: self.undo_stack.popleft()
+
+    def checkpoint(self, df: pd.DataFrame, types):
+        """将当前完整状态 (含撤销/重做栈) 写为新的日志起点，之前的日志记录随之丢弃"""
+        if not self.journal_path: return
+        tmp_path = self.journal_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(('checkpoint', {'df': df, 'types': list(types), 'undo': list(self.undo_stack), 'redo': list(self.redo_stack), 'max_depth': self.max_depth, 'max_bytes': self.max_bytes}), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.journal_path); self._since_checkpoint = 0
+
+    def _journal(self, record, df, types):
+        if not self.journal_path: return
+        self._since_checkpoint += 1
+        if self._since_checkpoint >= self.checkpoint_every: self.checkpoint(df, types); return
+        with open(self.journal_path, 'ab') as f: pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def replay(cls, journal_path: str, **kwargs):
+        """
+        从磁盘日志恢复会话，返回 (DataFrame, 类别列表, EditHistory)；恢复后的历史继续写入同一日志。
+        回放时不裁剪撤销栈，结束后再按 max_depth / max_bytes 裁剪 (未传入时沿用日志中保存的上限)。
+        """
+        records = []
+        with open(journal_path, 'rb') as f:
+            while True:
+                try: records.append(pickle.load(f))
+                except (EOFError, pickle.UnpicklingError): break  # 末尾记录可能因中断而不完整
+        start = max(i for i, r in enumerate(records) if r[0] == 'checkpoint')
+        state = records[start][1]
+        kwargs.pop('journal_path', None); kwargs.pop('overwrite_journal', None)
+        max_depth = kwargs.pop('max_depth', state.get('max_depth')); max_bytes = kwargs.pop('max_bytes', state.get('max_bytes'))
+        history = cls(state['df'], state['types'], max_depth=None, max_bytes=None, **kwargs)
+        history.undo_stack.extend(state['undo']); history.redo_stack.extend(state['redo'])
+        df, types = state['df'], list(state['types'])
+        for i, record in enumerate(records[start + 1:], start + 1):
+            if record[0] == 'do': df = history.do(record[1], df); types = list(record[1].types_after); continue
+            result = (history.undo if record[0] == 'undo' else history.redo)(df)
+            if result is None: raise ValueError(f"撤销日志 {journal_path} 已损坏：第 {i} 条记录 {record[0]!r} 没有可回放的操作。")
+            df, types = result
+        history.max_depth = max_depth; history.max_bytes = max_bytes; history._trim()
+        history.journal_path = journal_path; history.checkpoint(df, types)
+        return df, types, history
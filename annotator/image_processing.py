@@ -3,85 +3,320 @@
 import pandas as pd
 import numpy as np
 from PIL import Image
-from collections import Counter
-from sklearn.cluster import KMeans
+from scipy import ndimage
 import ast
+from .cache import cached_stage, file_content_hash, array_hash, frame_hash
+from .clustering import fit_color_palette, _pack_rgb, _unpack_rgb
+from .io import compact_annotations, COLOR_COLUMNS
+from .profiling import profile_stage
 
-def _get_valid_neighbors(y, x, grid_map, background_color, near_black_threshold, grid_height, grid_width):
-    # (此函数无需修改)
-    neighbors = []
-    for dy in [-1, 0, 1]:
-        for dx in [-1, 0, 1]:
-            if dx == 0 and dy == 0: continue
-            ny, nx = y + dy, x + dx
-            if 0 <= ny < grid_height and 0 <= nx < grid_width:
-                neighbor_color = grid_map[ny, nx]
-                if neighbor_color != background_color and sum(neighbor_color) >= near_black_threshold:
-                    neighbors.append(neighbor_color)
-    return neighbors
+try:
+    import tifffile
+except ImportError:  # 可选依赖：仅在流式读取 TIFF 时需要
+    tifffile = None
+
+# 可选的网格代表色提取方式
+TILE_REDUCERS = ('mode', 'mean', 'median', 'trimmed_mode')
+# process_cell_type_map 依次报告进度的阶段 (未启用邻里校正时跳过 correction)
+PIPELINE_STAGES = ('tile_colors', 'clustering', 'correction', 'merge')
+
+class GenerationCancelled(Exception):
+    """cancel 事件被置位，生成流程在阶段或条带之间中止"""
+
+def _checkpoint(progress, cancel, stage: str, fraction: float):
+    """报告 stage 的完成比例；cancel 已置位时抛出 GenerationCancelled"""
+    if progress is not None: progress(stage, fraction)
+    if cancel is not None and cancel.is_set(): raise GenerationCancelled(f"生成已在 {stage} 阶段取消。")
+
+def _tile_modes(keys, ignore_key=None):
+    """
+    批量求每个网格的众数颜色键。keys 形状为 (n_tiles, n_pixels)。
+    并列时取在网格内最先出现的颜色，与 Counter.most_common(1) 的结果完全一致。
+    ignore_key 不为 None 时该颜色不参与计票 (整块都是该颜色时仍返回它)。
+    """
+    n_tiles, n_pixels = keys.shape
+    order = np.argsort(keys, axis=1, kind='stable')
+    sorted_keys = np.take_along_axis(keys, order, axis=1)
+    run_start = np.ones(keys.shape, dtype=bool); run_start[:, 1:] = sorted_keys[:, 1:] != sorted_keys[:, :-1]
+    starts = np.flatnonzero(run_start.ravel())
+    counts = np.diff(np.append(starts, keys.size))
+    run_keys = sorted_keys.ravel()[starts]
+    if ignore_key is not None: counts = np.where(run_keys == ignore_key, 0, counts)
+    first_pos = order.ravel()[starts]; run_tile = starts // n_pixels
+    best = np.lexsort((first_pos, -counts, run_tile))
+    tile_sorted = run_tile[best]; is_first = np.ones(len(best), dtype=bool); is_first[1:] = tile_sorted[1:] != tile_sorted[:-1]
+    return run_keys[best[is_first]]
+
+def _reduce_tiles(tiles, reducer, background_color):
+    """将 (n_tiles, n_pixels, 3) 的像素块归约为 (n_tiles, 3) 的 uint8 代表色"""
+    if reducer == 'mode': return _unpack_rgb(_tile_modes(_pack_rgb(tiles)))
+    if reducer == 'trimmed_mode': return _unpack_rgb(_tile_modes(_pack_rgb(tiles), ignore_key=int(_pack_rgb(background_color))))
+    if reducer == 'mean': return np.rint(tiles.mean(axis=1)).astype(np.uint8)
+    if reducer == 'median': return np.rint(np.median(tiles, axis=1)).astype(np.uint8)
+    raise ValueError(f"未知的 reducer: {reducer!r}，可选值为 {TILE_REDUCERS}")
+
+def _reduce_band(band, grid_width, tile_height, tile_width, reducer, background_color, mask=None):
+    """
+    将若干整行网格的像素条带 (n_rows*tile_h, >= grid_w*tile_w, 3) 归约为 (n_rows, grid_w, 3)。
+    给定 (n_rows, grid_w) 的 mask 时只分析为 True 的网格，其余填充为背景色。
+    """
+    n_rows = band.shape[0] // tile_height
+    chunk = band[:n_rows * tile_height, :grid_width * tile_width, :3].reshape(n_rows, tile_height, grid_width, tile_width, 3)
+    if mask is None:
+        tiles = chunk.transpose(0, 2, 1, 3, 4).reshape(n_rows * grid_width, tile_height * tile_width, 3)
+        return _reduce_tiles(tiles, reducer, background_color).reshape(n_rows, grid_width, 3)
+    colors = np.empty((n_rows, grid_width, 3), dtype=np.uint8); colors[:] = background_color
+    ry, rx = np.nonzero(mask)
+    if ry.size: colors[ry, rx] = _reduce_tiles(chunk[ry, :, rx].reshape(ry.size, tile_height * tile_width, 3), reducer, background_color)
+    return colors
+
+def extract_tile_colors(img_array: np.ndarray, grid_width: int, grid_height: int, reducer: str = 'mode', background_color=(255, 255, 255), max_chunk_pixels: int = 1 << 22, mask: np.ndarray = None, on_band=None) -> np.ndarray:
+    """
+    将图像视为 (grid_h, tile_h, grid_w, tile_w, 3) 的网格视图，批量计算每个网格的代表色。
+    返回 (grid_height, grid_width, 3) 的 uint8 数组；按网格行分块处理以限制内存占用。
+    mask 为 (grid_height, grid_width) 的布尔数组时只分析被选中的网格，其余记为背景色。
+    on_band(已完成的网格行比例) 在每个条带处理完后调用，可在其中抛出异常以中止。
+    """
+    if reducer not in TILE_REDUCERS: raise ValueError(f"未知的 reducer: {reducer!r}，可选值为 {TILE_REDUCERS}")
+    img_height, img_width = img_array.shape[:2]
+    tile_height = img_height // grid_height; tile_width = img_width // grid_width
+    colors = np.empty((grid_height, grid_width, 3), dtype=np.uint8)
+    if tile_height == 0 or tile_width == 0: colors[:] = background_color; return colors
+    rows_per_chunk = max(1, max_chunk_pixels // (tile_height * grid_width * tile_width))
+    for y0 in range(0, grid_height, rows_per_chunk):
+        n_rows = min(rows_per_chunk, grid_height - y0)
+        band_mask = None if mask is None else mask[y0:y0 + n_rows]
+        if band_mask is not None and not band_mask.any(): colors[y0:y0 + n_rows] = background_color; continue  # 跳过的条带不单独报告进度
+        colors[y0:y0 + n_rows] = _reduce_band(img_array[y0 * tile_height:(y0 + n_rows) * tile_height], grid_width, tile_height, tile_width, reducer, background_color, band_mask)
+        if on_band is not None: on_band((y0 + n_rows) / grid_height)
+    return colors
+
+# (photometric, samples_per_pixel) -> 与 PIL 整图解码一致的模式
+_TIFF_PIL_MODES = {(1, 1): 'L', (1, 2): 'LA', (2, 3): 'RGB', (2, 4): 'RGBA', (3, 1): 'P', (5, 4): 'CMYK', (6, 3): 'RGB'}
+
+def _open_tiff_rows(image_path: str):
+    """若 TIFF 可按条带/瓦片流式解码，返回 (TiffFile, page, PIL 模式)，否则返回 None"""
+    if tifffile is None: return None
+    try: tif = tifffile.TiffFile(image_path)
+    except Exception: return None
+    page = tif.pages[0]
+    mode = _TIFF_PIL_MODES.get((int(page.photometric), page.samplesperpixel))
+    if mode is None or page.dtype != np.uint8 or page.planarconfig != 1 or page.imagedepth != 1 or (page.photometric == 6 and page.compression != 7):
+        tif.close(); return None
+    try: tifffile.TIFF.DECOMPRESSORS[page.compression]
+    except KeyError: tif.close(); return None  # 压缩格式需要未安装的 imagecodecs (如 LZW/JPEG)，交由整图解码
+    return tif, page, mode
+
+def _iter_tiff_rows(tif, page, mode):
+    """按行序逐段解码 TIFF 条带/瓦片，产出 (起始行, RGB 行块)；同一行的所有瓦片拼齐后才产出"""
+    height, width = page.imagelength, page.imagewidth
+    palette = (page.colormap // 256).astype(np.uint8).T.tobytes() if mode == 'P' else None
+    def to_rgb(block):
+        im = Image.frombytes(mode, (block.shape[1], block.shape[0]), block.tobytes())
+        if palette is not None: im.putpalette(palette)
+        return np.asarray(im.convert("RGB"))
+    with tif:
+        block = None; block_y = 0
+        for segment, (_, _, y, x, _), shape in page.segments():
+            if block is not None and y != block_y: yield block_y, to_rgb(block); block = None
+            if block is None: block_y = y; block = np.zeros((min(shape[1], height - y), width, shape[3]), dtype=np.uint8)
+            if segment is not None: block[:, x:x + shape[2]] = segment[0, :block.shape[0], :width - x]
+        if block is not None: yield block_y, to_rgb(block)
+
+def _image_size(image_path: str):
+    """返回图像的 (宽, 高)；可流式解码的 TIFF 从 tifffile 页头读取，避免触发 PIL 的解压炸弹像素上限"""
+    source = _open_tiff_rows(image_path)
+    if source is not None:
+        tif, page, _ = source
+        with tif: return page.imagewidth, page.imagelength
+    with Image.open(image_path) as img: return img.size
+
+def iter_image_bands(image_path: str, band_height: int):
+    """
+    逐条带读取图像并转换为 RGB，产出 (起始行, (h, W, 3) uint8 数组)。
+    安装了 tifffile 时 TIFF 按原生条带/瓦片惰性解码，峰值内存约为一个条带；其他情况回退为整图解码后切分。
+    """
+    source = _open_tiff_rows(image_path)
+    if source is None:
+        print("提示：未安装 tifffile 或图像不支持分块解码，将整图读入内存。")
+        img_array = np.array(Image.open(image_path).convert("RGB"))
+        for y0 in range(0, img_array.shape[0], band_height): yield y0, img_array[y0:y0 + band_height]
+        return
+    pending = []; pending_rows = 0; y0 = 0
+    for _, block in _iter_tiff_rows(*source):
+        pending.append(block); pending_rows += block.shape[0]
+        while pending_rows >= band_height:
+            buf = np.concatenate(pending) if len(pending) > 1 else pending[0]
+            yield y0, buf[:band_height]; y0 += band_height
+            rest = buf[band_height:]; pending = [rest] if rest.shape[0] else []; pending_rows = rest.shape[0]
+    if pending_rows: yield y0, np.concatenate(pending)
+
+def extract_tile_colors_from_file(image_path: str, grid_width: int, grid_height: int, reducer: str = 'mode', background_color=(255, 255, 255), max_chunk_pixels: int = 1 << 22, mask: np.ndarray = None, on_band=None) -> np.ndarray:
+    """extract_tile_colors 的流式版本：逐条带解码并归约后即丢弃像素，结果与整图读入完全一致"""
+    if reducer not in TILE_REDUCERS: raise ValueError(f"未知的 reducer: {reducer!r}，可选值为 {TILE_REDUCERS}")
+    img_width, img_height = _image_size(image_path)
+    tile_height = img_height // grid_height; tile_width = img_width // grid_width
+    colors = np.empty((grid_height, grid_width, 3), dtype=np.uint8); colors[:] = background_color
+    if tile_height == 0 or tile_width == 0: return colors
+    rows_per_band = max(1, max_chunk_pixels // (tile_height * img_width))
+    for y0, band in iter_image_bands(image_path, rows_per_band * tile_height):
+        g0 = y0 // tile_height
+        if g0 >= grid_height: break
+        n_rows = min(band.shape[0] // tile_height, grid_height - g0)
+        band_mask = None if mask is None else mask[g0:g0 + n_rows]
+        if n_rows and (band_mask is None or band_mask.any()):
+            colors[g0:g0 + n_rows] = _reduce_band(band[:n_rows * tile_height], grid_width, tile_height, tile_width, reducer, background_color, band_mask)
+        if on_band is not None: on_band((g0 + n_rows) / grid_height)
+    return colors
+
+def _color_grid_to_df(color_grid: np.ndarray, mask: np.ndarray = None) -> pd.DataFrame:
+    """将 (H, W, 3) 颜色网格展开为带 1 起始 int32 grid_x/grid_y 与 uint8 r/g/b 列的 DataFrame；mask 为 False 的网格被跳过"""
+    grid_height, grid_width = color_grid.shape[:2]
+    flat_idx = np.arange(grid_height * grid_width) if mask is None else np.flatnonzero(mask)
+    ys, xs = np.divmod(flat_idx, grid_width); colors = color_grid.reshape(-1, 3)[flat_idx].astype(np.uint8)
+    return pd.DataFrame({"grid_x": (xs + 1).astype(np.int32), "grid_y": (ys + 1).astype(np.int32), "r": colors[:, 0], "g": colors[:, 1], "b": colors[:, 2]})
+
+def _neighbor_offsets(radius: int = 1, connectivity: int = 8):
+    """按 (dy, dx) 行优先顺序返回邻域偏移；connectivity=4 为菱形邻域，8 为方形邻域"""
+    if connectivity not in (4, 8): raise ValueError(f"connectivity 只能为 4 或 8，当前为 {connectivity!r}")
+    if radius < 1: raise ValueError(f"radius 必须 >= 1，当前为 {radius!r}")
+    return [(dy, dx) for dy in range(-radius, radius + 1) for dx in range(-radius, radius + 1)
+            if (dy, dx) != (0, 0) and (connectivity == 8 or abs(dy) + abs(dx) <= radius)]
+
+def correct_near_black_grid(color_grid: np.ndarray, background_color, near_black_threshold: int, n_laps=2, radius: int = 1, connectivity: int = 8) -> np.ndarray:
+    """
+    向量化的邻里多数校正：把非背景的近黑网格替换为邻域内出现最多的有效颜色 (非背景且非近黑)。
+    并列时取邻域扫描顺序中最先出现的颜色，与逐格 Counter 实现一致。
+    n_laps 为 None 时迭代直至没有网格被校正。返回校正后的 (H, W, 3) uint8 数组。
+    """
+    offsets = _neighbor_offsets(radius, connectivity)
+    keys = _pack_rgb(color_grid); bg_key = int(_pack_rgb(background_color))
+    near_black = color_grid.astype(np.int32).sum(axis=2) < near_black_threshold
+    lap = 0
+    while n_laps is None or lap < n_laps:
+        valid = (keys != bg_key) & ~near_black
+        ty, tx = np.nonzero((keys != bg_key) & near_black)
+        correction_count = 0
+        if ty.size:
+            padded_keys = np.pad(np.where(valid, keys, -1), radius, constant_values=-1)
+            # (n_offsets, n_targets) 的邻居颜色键，无效邻居记为 -1
+            nb = np.stack([padded_keys[ty + radius + dy, tx + radius + dx] for dy, dx in offsets])
+            nb_valid = nb >= 0
+            votes = np.stack([np.where(nb_valid[i], (nb == nb[i]).sum(axis=0), 0) for i in range(len(offsets))])
+            fixed = nb_valid.any(axis=0); best = votes.argmax(axis=0)
+            new_keys = keys.copy(); new_keys[ty[fixed], tx[fixed]] = nb[best[fixed], np.flatnonzero(fixed)]
+            near_black = near_black.copy(); near_black[ty[fixed], tx[fixed]] = False
+            keys = new_keys; correction_count = int(fixed.sum())
+        if correction_count == 0 and (n_laps is None or lap > 0): break
+        lap += 1
+    return _unpack_rgb(keys)
+
+def spot_sampling_mask(spatial_df: pd.DataFrame, grid_width: int, grid_height: int, halo: int = 0, radius: int = 1, connectivity: int = 8):
+    """
+    返回 (spot_mask, sample_mask)：spot_mask 标记 spatial_df 中出现的网格 (x_coord/y_coord 从 1 开始)，
+    sample_mask 在其基础上按邻域再扩张 halo 圈，覆盖邻里校正需要读取的全部网格；halo 为 None 时为整个网格。
+    """
+    xs = spatial_df['x_coord'].to_numpy(dtype=np.int64) - 1; ys = spatial_df['y_coord'].to_numpy(dtype=np.int64) - 1
+    inside = (xs >= 0) & (xs < grid_width) & (ys >= 0) & (ys < grid_height)
+    spot_mask = np.zeros((grid_height, grid_width), dtype=bool); spot_mask[ys[inside], xs[inside]] = True
+    if halo is None: return spot_mask, np.ones_like(spot_mask)
+    if halo <= 0 or not spot_mask.any(): return spot_mask, spot_mask.copy()
+    structure = np.zeros((2 * radius + 1, 2 * radius + 1), dtype=bool); structure[radius, radius] = True
+    for dy, dx in _neighbor_offsets(radius, connectivity): structure[dy + radius, dx + radius] = True
+    return spot_mask, ndimage.binary_dilation(spot_mask, structure=structure, iterations=halo)
+
+def _fit_color_clusters(color_grid, mask, n_types, near_black_threshold, background_color, backend):
+    """取 (mask 内的) 网格唯一颜色及其频数，按首次出现顺序交给聚类后端，返回 ColorPalette 或 None"""
+    keys = _pack_rgb(color_grid).ravel() if mask is None else _pack_rgb(color_grid)[mask]
+    unique_keys, first_idx, counts = np.unique(keys, return_index=True, return_counts=True)
+    order = np.argsort(first_idx)
+    return fit_color_palette(_unpack_rgb(unique_keys[order]), counts[order], n_types, near_black_threshold, background_color, backend=backend)
+
+def _label_and_merge(color_grid, keep, palette, spatial_df):
+    """用调色板查找表为 keep 内的网格分配 Type_N (背景/近黑/无调色板时为 Unassigned)，再与 spatial_df 按坐标合并"""
+    valid_df = _color_grid_to_df(color_grid, keep)
+    valid_df['cell_type'] = pd.Categorical(np.full(len(valid_df), 'Unassigned', dtype=object) if palette is None else palette.type_names(_pack_rgb(color_grid)[keep]))
+    final_df = pd.merge(spatial_df, valid_df, left_on=['x_coord', 'y_coord'], right_on=['grid_x', 'grid_y'], how='inner')
+    return compact_annotations(final_df[['barcode', 'x_coord', 'y_coord', 'cell_type'] + COLOR_COLUMNS].rename(columns={'x_coord': 'grid_x', 'y_coord': 'grid_y'}))
 
 def process_cell_type_map(image_path: str, spatial_df: pd.DataFrame, **kwargs) -> pd.DataFrame:
-    # (此函数无需修改)
+    """
+    分阶段的自动注释流程：解码 → 网格代表色 → 颜色聚类 → 邻里校正 → 合并 Barcode。
+    传入 cache (StageCache) 时，各阶段结果以图像内容哈希及该阶段实际依赖的参数为键缓存，
+    例如只修改 n_types 时仅重新运行聚类及合并阶段。
+    传入 profiler (Profiler) 时记录各阶段的耗时/内存及是否命中缓存。
+    传入 progress(stage, fraction) 时在各阶段开始/结束及每个图像条带后报告进度 (stage 取自 PIPELINE_STAGES)；
+    传入 cancel (如 threading.Event) 时在这些位置检查，已置位则抛出 GenerationCancelled。
+    """
     grid_width = kwargs.get('grid_width', 50)
     grid_height = kwargs.get('grid_height', 50)
     n_types = kwargs.get('n_types', 6)
     correct_near_black = kwargs.get('correct_near_black', True)
     n_correction_laps = kwargs.get('n_correction_laps', 2)
+    correction_radius = kwargs.get('correction_radius', 1)
+    correction_connectivity = kwargs.get('correction_connectivity', 8)
     near_black_threshold = kwargs.get('near_black_threshold', 60)
     remove_background = kwargs.get('remove_background', True)
     background_color_str = kwargs.get('background_color_str', '(255, 255, 255)')
+    tile_reducer = kwargs.get('tile_reducer', 'mode')
+    streaming = kwargs.get('streaming', False)
+    sampling = kwargs.get('sampling', 'dense')
+    cluster_backend = kwargs.get('cluster_backend', 'kmeans')
+    cache = kwargs.get('cache', None)
+    profiler = kwargs.get('profiler', None)
+    progress = kwargs.get('progress', None)
+    cancel = kwargs.get('cancel', None)
+
+    background_color = tuple(ast.literal_eval(background_color_str))
+    spatial_df = spatial_df.astype({'x_coord': int, 'y_coord': int})
+    # sparse 模式：只分析 spatial_df 中出现的网格，以及邻里校正需要读取的邻域网格
+    spot_mask = sample_mask = None
+    if sampling == 'sparse':
+        # 迭代至收敛时校正的影响范围不受限，只能读取全部网格
+        halo = n_correction_laps if correct_near_black else 0
+        spot_mask, sample_mask = spot_sampling_mask(spatial_df, grid_width, grid_height, halo=halo, radius=correction_radius, connectivity=correction_connectivity)
+    elif sampling != 'dense': raise ValueError(f"未知的 sampling: {sampling!r}，可选值为 'dense' 或 'sparse'")
+    image_key = file_content_hash(image_path) if cache is not None else None
+    def _report_hit(hit, record):
+        if record is not None: record['cache_hit'] = hit
+        if hit: print("  - 使用缓存结果。")
 
-    img = Image.open(image_path).convert("RGB")
-    img_array = np.array(img)
-    img_height, img_width, _ = img_array.shape
-    background_color = ast.literal_eval(background_color_str)
-    
     print(f"--- 步骤 A: 图像分析 (网格大小: {grid_height}x{grid_width}) ---")
-    tile_height = img_height // grid_height; tile_width = img_width // grid_width
-    grid_data = []
-    for y_idx in range(grid_height):
-        for x_idx in range(grid_width):
-            y_start, y_end = y_idx * tile_height, (y_idx + 1) * tile_height; x_start, x_end = x_idx * tile_width, (x_idx + 1) * tile_width
-            tile = img_array[y_start:y_end, x_start:x_end, :]; pixels = tile.reshape(-1, 3); pixels_list = [tuple(p) for p in pixels]
-            most_common_color = Counter(pixels_list).most_common(1)[0][0] if pixels_list else background_color
-            grid_data.append({"grid_x": x_idx + 1, "grid_y": y_idx + 1, "color": most_common_color})
-    grid_df = pd.DataFrame(grid_data)
-
-    print(f"--- 步骤 B: 使用 K-Means 将颜色聚类为 {n_types} 类... ---")
-    unique_colors = np.array([list(c) for c in grid_df['color'].unique() if sum(c) >= near_black_threshold and c != background_color])
-    if len(unique_colors) < n_types: n_types = len(unique_colors)
-    kmeans = KMeans(n_clusters=n_types, random_state=42, n_init=10).fit(unique_colors) if n_types > 0 else None
-    valid_df = grid_df.copy()
-    if remove_background: valid_df = valid_df[valid_df['color'] != background_color].copy()
+    _checkpoint(progress, cancel, 'tile_colors', 0.0); on_band = lambda fraction: _checkpoint(progress, cancel, 'tile_colors', fraction)
+    def _tile_colors():
+        if streaming: return extract_tile_colors_from_file(image_path, grid_width, grid_height, reducer=tile_reducer, background_color=background_color, mask=sample_mask, on_band=on_band)
+        with profile_stage(profiler, 'decode') as record:
+            img_array, _, hit = cached_stage(cache, 'decode', (image_key,), lambda: np.array(Image.open(image_path).convert("RGB")), persist=False)
+            if record is not None: record['cache_hit'] = hit
+        _checkpoint(progress, cancel, 'tile_colors', 0.0)  # 整图解码无法中途打断，解码完成后再检查一次
+        return extract_tile_colors(img_array, grid_width, grid_height, reducer=tile_reducer, background_color=background_color, mask=sample_mask, on_band=on_band)
+    with profile_stage(profiler, 'tile_colors') as record:
+        color_grid, tile_key, hit = cached_stage(cache, 'tile_colors', lambda: (image_key, grid_width, grid_height, tile_reducer, background_color, array_hash(sample_mask)), _tile_colors)
+        _report_hit(hit, record)
+
+    print(f"--- 步骤 B: 使用 {cluster_backend} 将颜色聚类为 {n_types} 类... ---")
+    _checkpoint(progress, cancel, 'clustering', 0.0)
+    with profile_stage(profiler, 'clustering') as record:
+        palette, cluster_key, hit = cached_stage(cache, 'clustering', lambda: (tile_key, array_hash(spot_mask), n_types, near_black_threshold, background_color, cluster_backend),
+                                                 lambda: _fit_color_clusters(color_grid, spot_mask, n_types, near_black_threshold, background_color, cluster_backend))
+        _report_hit(hit, record)
+    corrected_grid, correction_key = color_grid, tile_key
     if correct_near_black:
         print(f"--- 步骤 C: 进行邻里校正... ---")
-        grid_map = np.empty((grid_height, grid_width), dtype=object)
-        for _, row in grid_df.iterrows(): grid_map[row['grid_y']-1, row['grid_x']-1] = row['color']
-        for lap in range(n_correction_laps):
-            correction_count = 0; new_grid_map = grid_map.copy()
-            for y in range(grid_height):
-                for x in range(grid_width):
-                    current_color = grid_map[y, x]
-                    if current_color == background_color: continue
-                    if sum(current_color) < near_black_threshold:
-                        neighbors = _get_valid_neighbors(y, x, grid_map, background_color, near_black_threshold, grid_height, grid_width)
-                        if neighbors: new_grid_map[y, x] = Counter(neighbors).most_common(1)[0][0]; correction_count += 1
-            grid_map = new_grid_map
-            if correction_count == 0 and lap > 0: break
-        corrected_data = []
-        for y in range(grid_height):
-            for x in range(grid_width):
-                color = grid_map[y, x]
-                if not (remove_background and color == background_color): corrected_data.append({"grid_x": x + 1, "grid_y": y + 1, "color": color})
-        valid_df = pd.DataFrame(corrected_data)
+        _checkpoint(progress, cancel, 'correction', 0.0)
+        with profile_stage(profiler, 'correction') as record:
+            corrected_grid, correction_key, hit = cached_stage(cache, 'correction', (tile_key, n_correction_laps, correction_radius, correction_connectivity, near_black_threshold, background_color),
+                                                               lambda: correct_near_black_grid(color_grid, background_color, near_black_threshold, n_laps=n_correction_laps, radius=correction_radius, connectivity=correction_connectivity))
+            _report_hit(hit, record)
+
     print(f"--- 步骤 D: 映射细胞类型并合并 Barcode... ---")
-    if kmeans:
-        final_colors = np.array([list(c) for c in valid_df['color'].unique() if sum(c) >= near_black_threshold and c != background_color])
-        if len(final_colors) > 0:
-            final_labels = kmeans.predict(final_colors)
-            final_color_map = {tuple(color): f"Type_{label+1}" for color, label in zip(final_colors, final_labels)}
-            valid_df['cell_type'] = valid_df['color'].map(final_color_map)
-    valid_df['cell_type'].fillna('Unassigned', inplace=True)
-    spatial_df = spatial_df.astype({'x_coord': int, 'y_coord': int})
-    final_df = pd.merge(spatial_df, valid_df, left_on=['x_coord', 'y_coord'], right_on=['grid_x', 'grid_y'], how='inner')
-    return final_df[['barcode', 'x_coord', 'y_coord', 'cell_type', 'color']].rename(columns={'x_coord': 'grid_x', 'y_coord': 'grid_y'})
\ No newline at end of file
+    _checkpoint(progress, cancel, 'merge', 0.0)
+    with profile_stage(profiler, 'merge') as record:
+        keep = _pack_rgb(corrected_grid) != int(_pack_rgb(background_color)) if remove_background else np.ones(corrected_grid.shape[:2], dtype=bool)
+        if spot_mask is not None: keep &= spot_mask
+        final_df, _, hit = cached_stage(cache, 'merge', lambda: (cluster_key, correction_key, array_hash(keep), frame_hash(spatial_df)),
+                                        lambda: _label_and_merge(corrected_grid, keep, palette, spatial_df), persist=False)
+        _report_hit(hit, record)
+        if record is not None: record['n_spots'] = len(final_df)
+    if progress is not None: progress('merge', 1.0)
+    return final_df.copy() if cache is not None else final_df
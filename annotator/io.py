@@ -0,0 +1,152 @@
+# annotator/io.py
+
+import os
+import numpy as np
+import pandas as pd
+from .spatial import CoordinateIndex
+
+# 常见的列名写法，用于自动匹配 barcode / 坐标 / 类型列
+COLUMN_PATTERNS = {'barcode': ['barcode', 'barcodes', 'cell_id'], 'x': ['x', 'x_coord', 'grid_x', 'array_col', 'x_coordinate'], 'y': ['y', 'y_coord', 'grid_y', 'array_row', 'y_coordinate'], 'type': ['type', 'cell_type', 'label', 'annotation', 'cluster']}
+
+def guess_column_names(columns):
+    """按 COLUMN_PATTERNS 猜测各列的实际列名 (不区分大小写)，返回 {'barcode'/'x'/'y'/'type': 列名}"""
+    guesses = {}; cols_lower = {c.lower(): c for c in columns}
+    for key, p_list in COLUMN_PATTERNS.items():
+        for p in p_list:
+            if p in cols_lower: guesses[key] = cols_lower[p]; break
+    return guesses
+
+def read_coordinates(path: str) -> pd.DataFrame:
+    """读取坐标 CSV，自动匹配列名并返回含 barcode, x_coord, y_coord 的 DataFrame (缺少 barcode 时生成占位符)"""
+    df = pd.read_csv(path); guesses = guess_column_names(df.columns)
+    if 'x' not in guesses or 'y' not in guesses: raise ValueError(f"坐标文件 {path} 中找不到 X/Y 坐标列。")
+    rename_map = {guesses['x']: 'x_coord', guesses['y']: 'y_coord'}
+    if 'barcode' in guesses: rename_map[guesses['barcode']] = 'barcode'
+    df = df.rename(columns=rename_map)
+    if 'barcode' not in df.columns: df['barcode'] = spot_barcodes(df['x_coord'], df['y_coord'])
+    return df[['barcode', 'x_coord', 'y_coord']]
+
+def read_csv_chunked(path: str, chunksize: int = 1 << 18, on_chunk=None, **kwargs) -> pd.DataFrame:
+    """
+    分块读取 CSV 后拼接 (各块列类型不一致时按 concat 规则统一)，参数同 pd.read_csv。
+    on_chunk(已读取字节比例) 在每块读完后调用，可在其中抛出异常以中止读取。
+    """
+    total = max(os.path.getsize(path), 1); chunks = []
+    with open(path, 'rb') as f:
+        for chunk in pd.read_csv(f, chunksize=chunksize, **kwargs):
+            chunks.append(chunk)
+            if on_chunk is not None: on_chunk(min(f.tell() / total, 1.0))
+    return chunks[0] if len(chunks) == 1 else pd.concat(chunks, ignore_index=True)
+
+def spot_barcodes(xs, ys, prefix: str = 'spot') -> np.ndarray:
+    """批量生成 {prefix}_{y}_{x} 形式的占位符 barcode：每个不同的 x / y 只格式化一次，再整列拼接"""
+    x_codes, x_values = pd.factorize(np.asarray(xs)); y_codes, y_values = pd.factorize(np.asarray(ys))
+    x_parts = np.array([str(v) for v in x_values.tolist()] + [''], dtype=object); y_parts = np.array([f"{prefix}_{v}_" for v in y_values.tolist()] + [''], dtype=object)
+    return y_parts[y_codes] + x_parts[x_codes]
+
+def placeholder_coordinates(grid_width: int, grid_height: int) -> pd.DataFrame:
+    """未提供坐标文件时，为整个网格生成 spot_{y}_{x} 形式的占位符 barcode"""
+    x_coords = np.tile(np.arange(1, grid_width + 1, dtype=np.int32), max(grid_height, 0)); y_coords = np.repeat(np.arange(1, grid_height + 1, dtype=np.int32), max(grid_width, 0))
+    return pd.DataFrame({'barcode': spot_barcodes(x_coords, y_coords), 'x_coord': x_coords, 'y_coord': y_coords})
+
+def match_barcodes(df: pd.DataFrame, master_df: pd.DataFrame, prefix: str = 'spot'):
+    """
+    按 (grid_x, grid_y) 在官方坐标表 master_df 中查找各点的 barcode，返回 (barcode 数组, 未匹配掩码)；
+    未匹配或官方 barcode 缺失的点使用 {prefix}_{y}_{x} 占位符。与按坐标 merge 不同，官方表中的重复坐标不会使点被复制。
+    """
+    rows = CoordinateIndex(master_df['grid_x'].to_numpy(), master_df['grid_y'].to_numpy()).lookup(df['grid_x'].to_numpy(), df['grid_y'].to_numpy())
+    barcodes = master_df['barcode'].to_numpy(dtype=object)[np.maximum(rows, 0)] if len(master_df) else np.empty(len(df), dtype=object)
+    unmatched = (rows < 0) | pd.isna(barcodes)  # 官方表中 barcode 缺失的坐标同样使用占位符
+    if unmatched.any(): barcodes[unmatched] = spot_barcodes(df['grid_x'].to_numpy()[unmatched], df['grid_y'].to_numpy()[unmatched], prefix)
+    return barcodes, unmatched
+
+# 紧凑的注释表：barcode, int32 坐标, 类别型 cell_type 与 uint8 的 r/g/b 三列；CSV 导出时合并为 "(r, g, b)" 字符串的 color 列
+COLOR_COLUMNS = ['r', 'g', 'b']
+ANNOTATION_COLUMNS = ['barcode', 'grid_x', 'grid_y', 'cell_type'] + COLOR_COLUMNS
+CSV_COLUMNS = ['barcode', 'grid_x', 'grid_y', 'cell_type', 'color']
+DEFAULT_COLOR = (128, 128, 128)
+NPZ_FORMAT_VERSION = 1
+
+_COLOR_TRANS = str.maketrans('()[]', '    '); _COLOR_BYTES = np.zeros(256, dtype=bool); _COLOR_BYTES[np.frombuffer(b'0123456789,; ', dtype=np.uint8)] = True
+
+def parse_colors(values) -> np.ndarray:
+    """将 "(r, g, b)" 字符串或 (r, g, b) 元组组成的序列解析为 (N, 3) uint8 数组"""
+    values = pd.Series(values); n = len(values)
+    if n == 0: return np.zeros((0, 3), dtype=np.uint8)
+    if values.isna().any(): raise ValueError("'color' 列包含缺失值。")
+    if pd.api.types.infer_dtype(values, skipna=False) == 'string':
+        # 各行以 ';' 拼接后整体交给 NumPy 解析 (避免逐行 ast.literal_eval)，并按行检查恰好有 3 个分量
+        text = ';'.join(values.tolist()).translate(_COLOR_TRANS)
+        try: buf = np.frombuffer(text.encode('ascii'), dtype=np.uint8)
+        except UnicodeEncodeError: raise ValueError("'color' 列包含无效格式。") from None
+        if not _COLOR_BYTES[buf].all(): raise ValueError("'color' 列包含无效格式。")
+        row_of_comma = np.searchsorted(np.flatnonzero(buf == ord(';')), np.flatnonzero(buf == ord(',')))
+        if (np.bincount(row_of_comma, minlength=n) != 2).any(): raise ValueError("'color' 列包含无效格式。")
+        # 每个分量恰好是一段连续数字 (排除 '1,,3' 与 '1 2,3,4')
+        is_digit = (buf >= ord('0')) & (buf <= ord('9')); run_start = is_digit.copy(); run_start[1:] &= ~is_digit[:-1]
+        component = np.cumsum((buf == ord(',')) | (buf == ord(';')))[run_start]
+        if len(component) != n * 3 or (np.bincount(component, minlength=n * 3) != 1).any(): raise ValueError("'color' 列包含无效格式。")
+        flat = np.fromstring(text.replace(';', ','), dtype=np.int64, sep=',')
+    else:
+        # 元组列；缺失值或混入的字符串在转换时抛出 ValueError/TypeError
+        try: flat = np.asarray(values.tolist(), dtype=np.int64).ravel()
+        except (TypeError, ValueError): raise ValueError("'color' 列包含无效格式。") from None
+    if flat.size != n * 3 or (flat < 0).any() or (flat > 255).any(): raise ValueError("'color' 列包含无效格式。")
+    return flat.reshape(n, 3).astype(np.uint8)
+
+def color_strings(df: pd.DataFrame) -> pd.Series:
+    """由 r/g/b 列生成与旧版 CSV 兼容的 "(r, g, b)" 字符串列"""
+    r, g, b = (df[c].astype(str) for c in COLOR_COLUMNS)
+    return '(' + r + ', ' + g + ', ' + b + ')'
+
+def compact_annotations(df: pd.DataFrame, default_color=DEFAULT_COLOR) -> pd.DataFrame:
+    """
+    转换为紧凑的注释表：grid_x/grid_y 为 int32，cell_type 为类别型，颜色为 uint8 的 r/g/b 列
+    (由 color 列解析，缺失时填充 default_color)。其余列原样保留在末尾。
+    """
+    out = pd.DataFrame(index=pd.RangeIndex(len(df)))
+    if 'barcode' in df.columns: out['barcode'] = df['barcode'].to_numpy()
+    for col in ('grid_x', 'grid_y'): out[col] = df[col].to_numpy().astype(np.int32)
+    if 'cell_type' not in df.columns: out['cell_type'] = pd.Categorical(['Unassigned'] * len(df))
+    elif isinstance(df['cell_type'].dtype, pd.CategoricalDtype) and all(isinstance(c, str) for c in df['cell_type'].cat.categories): out['cell_type'] = df['cell_type'].array
+    else: out['cell_type'] = pd.Categorical(df['cell_type'].astype(str).to_numpy())
+    if all(c in df.columns for c in COLOR_COLUMNS): colors = df[COLOR_COLUMNS].to_numpy().astype(np.uint8)
+    elif 'color' in df.columns: colors = parse_colors(df['color'])
+    else: colors = np.tile(np.asarray(default_color, dtype=np.uint8), (len(df), 1))
+    for i, col in enumerate(COLOR_COLUMNS): out[col] = colors[:, i]
+    for col in df.columns:
+        if col not in out.columns and col != 'color': out[col] = df[col].to_numpy()
+    return out
+
+def _pack_strings(values) -> np.ndarray:
+    # 以换行符拼接后按 UTF-8 存为字节数组，比定长 Unicode 数组小得多且读写更快
+    return np.frombuffer('\n'.join(pd.Series(values).astype(str).to_numpy(dtype=object).tolist()).encode('utf-8'), dtype=np.uint8)
+
+def _unpack_strings(buffer: np.ndarray, n: int):
+    return buffer.tobytes().decode('utf-8').split('\n') if n else []
+
+def save_annotations(df: pd.DataFrame, path: str, file_format: str = None):
+    """
+    保存注释表。file_format 为 'npz' (二进制会话格式，默认按扩展名判断) 或 'csv'
+    (导出格式，列为 barcode,grid_x,grid_y,cell_type,color)。
+    """
+    file_format = file_format or ('csv' if path.lower().endswith('.csv') else 'npz')
+    df = compact_annotations(df)
+    if file_format == 'csv':
+        out = df[['barcode', 'grid_x', 'grid_y', 'cell_type']].copy(); out['color'] = color_strings(df)
+        out.to_csv(path, index=False, columns=CSV_COLUMNS); return
+    if file_format != 'npz': raise ValueError(f"未知的保存格式: {file_format!r}")
+    cell_type = df['cell_type'].cat.remove_unused_categories()
+    with open(path, 'wb') as f:  # 传入文件对象，避免 np.savez 自动追加 .npz 扩展名
+        np.savez(f, version=np.int32(NPZ_FORMAT_VERSION), n=np.int64(len(df)), barcode=_pack_strings(df['barcode']), grid_x=df['grid_x'].to_numpy(), grid_y=df['grid_y'].to_numpy(),
+                 type_codes=cell_type.cat.codes.to_numpy(), n_types=np.int64(len(cell_type.cat.categories)), type_names=_pack_strings(cell_type.cat.categories), rgb=df[COLOR_COLUMNS].to_numpy())
+
+def load_annotations(path: str) -> pd.DataFrame:
+    """读取 save_annotations 写出的 .npz 会话文件或标准列名的 CSV，返回紧凑注释表"""
+    if os.path.splitext(path)[1].lower() != '.npz': return compact_annotations(pd.read_csv(path))
+    with np.load(path) as data:
+        if int(data['version']) > NPZ_FORMAT_VERSION: raise ValueError(f"{path} 的格式版本 ({int(data['version'])}) 高于当前支持的版本。")
+        n = int(data['n']); type_names = _unpack_strings(data['type_names'], int(data['n_types'])); rgb = data['rgb']
+        df = pd.DataFrame({'barcode': _unpack_strings(data['barcode'], n), 'grid_x': data['grid_x'], 'grid_y': data['grid_y'],
+                           'cell_type': pd.Categorical.from_codes(data['type_codes'], categories=type_names), 'r': rgb[:, 0], 'g': rgb[:, 1], 'b': rgb[:, 2]})
+    return df
@@ -0,0 +1,93 @@
+# annotator/spatial.py
+
+import numpy as np
+from matplotlib.path import Path
+
+class GridIndex:
+    """
+    点坐标的均匀网格桶索引：按 (桶行, 桶列) 排序后每个桶对应 order 中的一段连续区间。
+    套索选择时只取多边形外接矩形覆盖的桶内的点做精确的 contains_points 测试。
+    """
+    def __init__(self, coords, bucket_size: float = None, buckets_per_side: int = 64):
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        if len(self.coords): self.origin = self.coords.min(axis=0); extent = self.coords.max(axis=0) - self.origin
+        else: self.origin = np.zeros(2); extent = np.zeros(2)
+        # 坐标为整数网格位置，桶边长至少为 1 个网格单位
+        self.bucket_size = float(bucket_size or max(1.0, float(extent.max()) / buckets_per_side))
+        cells = ((self.coords - self.origin) // self.bucket_size).astype(np.int64)
+        self.shape = (int(extent[0] // self.bucket_size) + 1, int(extent[1] // self.bucket_size) + 1)
+        keys = cells[:, 1] * self.shape[0] + cells[:, 0]
+        if self.shape[0] * self.shape[1] <= np.iinfo(np.uint16).max: keys = keys.astype(np.uint16)  # 桶数较少时稳定排序走基数排序
+        self.order = np.argsort(keys, kind='stable')
+        self.starts = np.searchsorted(keys[self.order], np.arange(self.shape[0] * self.shape[1] + 1))
+
+    def __len__(self): return len(self.coords)
+
+    def query_bbox(self, xmin, ymin, xmax, ymax) -> np.ndarray:
+        """返回落在闭矩形 [xmin, xmax] x [ymin, ymax] 内的点的行号"""
+        if not len(self.coords): return np.empty(0, dtype=np.int64)
+        lo = np.floor((np.array([xmin, ymin]) - self.origin) / self.bucket_size).astype(np.int64)
+        hi = np.floor((np.array([xmax, ymax]) - self.origin) / self.bucket_size).astype(np.int64)
+        if (hi < 0).any() or lo[0] >= self.shape[0] or lo[1] >= self.shape[1]: return np.empty(0, dtype=np.int64)
+        lo = np.maximum(lo, 0); hi = np.minimum(hi, np.array(self.shape) - 1)
+        rows = np.arange(lo[1], hi[1] + 1) * self.shape[0]
+        begin, end = self.starts[rows + lo[0]], self.starts[rows + hi[0] + 1]
+        candidates = np.concatenate([self.order[b:e] for b, e in zip(begin, end)]) if len(rows) else np.empty(0, dtype=np.int64)
+        pts = self.coords[candidates]
+        keep = (pts[:, 0] >= xmin) & (pts[:, 0] <= xmax) & (pts[:, 1] >= ymin) & (pts[:, 1] <= ymax)
+        return candidates[keep]
+
+    def contains(self, vertices) -> np.ndarray:
+        """返回套索多边形内点的布尔掩码 (长度与点数相同)"""
+        mask = np.zeros(len(self.coords), dtype=bool)
+        vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+        if not len(vertices) or not len(self.coords): return mask
+        (xmin, ymin), (xmax, ymax) = vertices.min(axis=0), vertices.max(axis=0)
+        candidates = self.query_bbox(xmin, ymin, xmax, ymax)
+        if len(candidates): mask[candidates[Path(vertices).contains_points(self.coords[candidates])]] = True
+        return mask
+
+def pack_coords(xs, ys) -> np.ndarray:
+    """把整数 (x, y) 网格坐标打包为可排序的 int64 键"""
+    return (np.asarray(xs, dtype=np.int64) << 32) | (np.asarray(ys, dtype=np.int64) + (1 << 31))
+
+class CoordinateIndex:
+    """
+    (grid_x, grid_y) → 行号 的索引：打包后的坐标键有序存放，查找为一次 searchsorted。
+    新增、删除、按原位置插回行时增量维护 (行号随之平移)，无需重新扫描整张表。
+    坐标重复时查找返回其中任意一行。
+    """
+    def __init__(self, xs=(), ys=()):
+        keys = pack_coords(xs, ys); self.n = len(keys)
+        order = np.argsort(keys, kind='stable'); self.keys = keys[order]; self.rows = order.astype(np.int64)
+
+    def __len__(self): return self.n
+
+    def lookup(self, xs, ys) -> np.ndarray:
+        """返回各坐标所在的行号，不存在时为 -1"""
+        query = pack_coords(xs, ys); pos = np.searchsorted(self.keys, query)
+        found = pos < len(self.keys); found[found] = self.keys[pos[found]] == query[found]
+        return np.where(found, self.rows[np.minimum(pos, len(self.keys) - 1)] if len(self.keys) else -1, -1)
+
+    def contains(self, x, y) -> bool: return bool(self.lookup([x], [y])[0] >= 0)
+
+    def _merge(self, keys, rows):
+        order = np.argsort(keys, kind='stable'); keys, rows = keys[order], rows[order]
+        pos = np.searchsorted(self.keys, keys, side='right')
+        self.keys = np.insert(self.keys, pos, keys); self.rows = np.insert(self.rows, pos, rows)
+
+    def add(self, xs, ys):
+        """在表尾追加若干行"""
+        keys = pack_coords(xs, ys); self._merge(keys, np.arange(self.n, self.n + len(keys), dtype=np.int64)); self.n += len(keys)
+
+    def delete(self, indices):
+        """删除若干行 (其后的行号前移)"""
+        removed = np.zeros(self.n, dtype=bool); removed[np.asarray(indices, dtype=np.int64)] = True
+        keep = ~removed[self.rows]; self.keys = self.keys[keep]; self.rows = self.rows[keep]
+        self.rows -= np.cumsum(removed)[self.rows]; self.n -= int(removed.sum())
+
+    def insert(self, indices, xs, ys):
+        """把行插回到 indices (插入后的行号) 处，即 delete 的逆操作"""
+        indices = np.asarray(indices, dtype=np.int64); total = self.n + len(indices)
+        inserted = np.zeros(total, dtype=bool); inserted[indices] = True
+        self.rows = np.flatnonzero(~inserted)[self.rows]; self._merge(pack_coords(xs, ys), indices); self.n = total
@@ -0,0 +1,209 @@
+# benchmarks/bench.py
+"""
+可复现的性能基准：合成标注图像与坐标文件，分别计时 process_cell_type_map 的各阶段，
+并在 Agg 后端下无界面地驱动 CellTypeAnnotator 执行套索/改类型/删除/撤销/重做/保存等操作。
+每个用例在独立进程中运行，以便记录互不干扰的进程内存峰值。结果写为 JSON，可与之前的基准比较。
+
+用法示例:
+    python benchmarks/bench.py -o benchmarks/baseline.json                    # 默认 small + medium
+    python benchmarks/bench.py --scales small medium large --repeat 5 -o new.json
+    python benchmarks/bench.py -o new.json --compare benchmarks/baseline.json  # 有回归时退出码为 1
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path: sys.path.insert(0, ROOT)
+
+# 规模：网格边长 (spots) 与合成图像的像素数
+SCALES = {'small': {'grid': 50, 'image_pixels': 1_000_000}, 'medium': {'grid': 200, 'image_pixels': 20_000_000}, 'large': {'grid': 1000, 'image_pixels': 200_000_000}}
+# 覆盖度：dense 为整张网格都有 spot，sparse 为约 25% 的网格有 spot (并使用 sampling='sparse')
+COVERAGES = {'dense': 1.0, 'sparse': 0.25}
+N_TYPES = 6
+
+def synth_label_image(path: str, side: int, n_types: int = N_TYPES, seed: int = 0):
+    """合成 side x side 的标注图像：n_types 种颜色的 Voronoi 区域、椭圆组织外的白色背景，以及少量近黑色斑点"""
+    import numpy as np
+    from PIL import Image
+    rng = np.random.default_rng(seed)
+    low = max(min(side // 16, 1024), 8); factor = -(-side // low)
+    seeds = rng.uniform(0, low, (n_types * 4, 2)); yy, xx = np.mgrid[0:low, 0:low].astype(np.float32)
+    labels = np.argmin(np.stack([(xx - sx) ** 2 + (yy - sy) ** 2 for sx, sy in seeds]), axis=0) % n_types
+    labels[((xx - low / 2) / (0.45 * low)) ** 2 + ((yy - low / 2) / (0.40 * low)) ** 2 > 1] = n_types       # 背景
+    labels[rng.random((low, low)) < 0.01] = n_types + 1                                                        # 近黑斑点
+    colors = np.vstack([rng.integers(70, 230, (n_types, 3)), [[255, 255, 255], [15, 15, 15]]]).astype(np.uint8)
+    rgb = colors[np.repeat(np.repeat(labels.astype(np.uint8), factor, axis=0), factor, axis=1)[:side, :side]]
+    Image.fromarray(rgb).save(path)
+
+def synth_coordinates(grid: int, coverage: float, seed: int = 0):
+    """整张网格或随机 coverage 比例网格的坐标表 (barcode, x_coord, y_coord)"""
+    import numpy as np
+    from annotator.io import placeholder_coordinates
+    df = placeholder_coordinates(grid, grid)
+    if coverage < 1: df = df.iloc[np.sort(np.random.default_rng(seed).choice(len(df), int(len(df) * coverage), replace=False))].reset_index(drop=True)
+    return df
+
+def _peak_rss_mb():
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(rss / (2**20 if sys.platform == 'darwin' else 2**10), 1)  # macOS 以字节计，Linux 以 KB 计
+    except ImportError: return None
+
+def _editor_ops(annotator, work_dir):
+    """按固定顺序执行编辑操作；耗时由编辑器自身的 profiler 记录"""
+    import numpy as np
+    xs, ys = annotator.df['grid_x'].to_numpy(), annotator.df['grid_y'].to_numpy()
+    x0, x1, y0, y1 = xs.min(), xs.max(), ys.min(), ys.max(); w, h = x1 - x0, y1 - y0
+    # 约覆盖 1/4 面积的多边形套索，随后 Shift 增选与 Ctrl 减选
+    theta = np.linspace(0, 2 * np.pi, 64, endpoint=False)
+    lasso = lambda cx, cy, r: np.c_[x0 + w * (cx + r * np.cos(theta)), y0 + h * (cy + r * np.sin(theta))]
+    annotator._on_select(lasso(0.4, 0.4, 0.28))
+    annotator.shift_pressed = True; annotator._on_select(lasso(0.65, 0.6, 0.15)); annotator.shift_pressed = False
+    annotator.ctrl_pressed = True; annotator._on_select(lasso(0.4, 0.4, 0.1)); annotator.ctrl_pressed = False
+    annotator.update_as_new_input.value = 'Bench_Type'; annotator._on_update_click(None)
+    annotator._on_select(lasso(0.7, 0.3, 0.15)); annotator._on_delete_points_click(None)
+    annotator._on_undo_click(None); annotator._on_undo_click(None); annotator._on_redo_click(None)
+    annotator.filename_input.value = os.path.join(work_dir, 'bench_annotations.npz'); annotator._on_save_click(None); annotator._on_export_csv_click(None)
+
+def _summarize(records):
+    """按操作/阶段名汇总 (同名记录的耗时相加，内存峰值取最大)"""
+    summary = {}
+    for r in records:
+        entry = summary.setdefault(r['name'], {'seconds': 0.0, 'calls': 0})
+        entry['seconds'] = round(entry['seconds'] + r['seconds'], 6); entry['calls'] += 1
+        if 'peak_mb' in r: entry['peak_mb'] = max(entry.get('peak_mb', 0.0), r['peak_mb'])
+    return summary
+
+def run_case(scale: str, coverage: str, seed: int = 0, memory: bool = True, editor: bool = True) -> dict:
+    """在当前进程中运行一个用例并返回结果 dict"""
+    import matplotlib; matplotlib.use('Agg')
+    import contextlib, io
+    from annotator.image_processing import process_cell_type_map
+    from annotator.editor import CellTypeAnnotator
+    from annotator.profiling import Profiler
+    from PIL import Image
+    Image.MAX_IMAGE_PIXELS = None  # large 规模的合成图像超过 PIL 默认的解压炸弹阈值 (约 1.79 亿像素)
+    spec = SCALES[scale]; grid = spec['grid']
+    side = max(grid, int(round(spec['image_pixels'] ** 0.5 / grid)) * grid)
+    result = {'scale': scale, 'coverage': coverage, 'grid': grid, 'image_side': side, 'seed': seed}
+    with tempfile.TemporaryDirectory() as work_dir:
+        image_path = os.path.join(work_dir, 'labels.tif')
+        start = time.perf_counter(); synth_label_image(image_path, side, seed=seed); result['synth_seconds'] = round(time.perf_counter() - start, 3)
+        spatial_df = synth_coordinates(grid, COVERAGES[coverage], seed=seed); result['n_coordinates'] = len(spatial_df)
+        params = {'grid_width': grid, 'grid_height': grid, 'n_types': N_TYPES, 'sampling': 'sparse' if COVERAGES[coverage] < 1 else 'dense'}
+        profiler = Profiler(memory=memory)
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter(); annotations = process_cell_type_map(image_path, spatial_df, profiler=profiler, **params); result['pipeline_seconds'] = round(time.perf_counter() - start, 6)
+        result['pipeline'] = _summarize(profiler.records); result['n_spots'] = len(annotations)
+        if editor and len(annotations):
+            # 编辑器计时不开启内存统计，避免 tracemalloc 放大绘图开销
+            editor_profiler = Profiler()
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter(); annotator = CellTypeAnnotator(annotations, profiler=editor_profiler); result['editor_init_seconds'] = round(time.perf_counter() - start, 6)
+                _editor_ops(annotator, work_dir)
+            result['editor'] = _summarize(r for r in editor_profiler.records if r['depth'] == 0)
+    result['peak_rss_mb'] = _peak_rss_mb()
+    return result
+
+def _run_isolated(scale, coverage, seed, memory, editor):
+    # 每个用例使用全新的 spawn 进程，保证进程内存峰值互不影响
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(run_case, scale, coverage, seed, memory, editor).result()
+
+def _best_of(runs):
+    """多次重复时，各耗时取最小值 (内存取最大值)；各耗时的最大值另记为 max_seconds / *_max，作为比较时的噪声范围"""
+    best = json.loads(json.dumps(runs[0]))
+    for group in ('pipeline', 'editor'):
+        for entry in best.get(group, {}).values(): entry['max_seconds'] = entry['seconds']
+    for key in ('pipeline_seconds', 'editor_init_seconds'):
+        if key in best: best[key[:-len('_seconds')] + '_max_seconds'] = best[key]
+    for run in runs[1:]:
+        for key in ('pipeline_seconds', 'editor_init_seconds', 'synth_seconds'):
+            if key in run: best[key] = min(best[key], run[key])
+        for key in ('pipeline_seconds', 'editor_init_seconds'):
+            if key in run: max_key = key[:-len('_seconds')] + '_max_seconds'; best[max_key] = max(best.get(max_key, run[key]), run[key])
+        for group in ('pipeline', 'editor'):
+            for name, entry in run.get(group, {}).items():
+                target = best.setdefault(group, {}).setdefault(name, dict(entry, max_seconds=entry['seconds']))
+                target['seconds'] = min(target['seconds'], entry['seconds']); target['max_seconds'] = max(target['max_seconds'], entry['seconds'])
+                if 'peak_mb' in entry: target['peak_mb'] = max(target.get('peak_mb', 0.0), entry['peak_mb'])
+        if run.get('peak_rss_mb') is not None: best['peak_rss_mb'] = max(best['peak_rss_mb'] or 0, run['peak_rss_mb'])
+    best['repeat'] = len(runs)
+    return best
+
+def _metadata():
+    import numpy, pandas, matplotlib
+    try: commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError): commit = None
+    return {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'numpy': numpy.__version__, 'pandas': pandas.__version__, 'matplotlib': matplotlib.__version__}
+
+def _metrics(case: dict, spread: bool = False):
+    """展开为 {指标名: 秒数} 以便比较；spread=True 时取重复运行中的最大耗时 (旧结果没有时退回最小值)"""
+    metrics = {'pipeline_total': case.get('pipeline_max_seconds' if spread and 'pipeline_max_seconds' in case else 'pipeline_seconds')}
+    if 'editor_init_seconds' in case: metrics['editor_init'] = case.get('editor_init_max_seconds', case['editor_init_seconds']) if spread else case['editor_init_seconds']
+    for group in ('pipeline', 'editor'):
+        for name, entry in case.get(group, {}).items(): metrics[f"{group}.{name}"] = entry.get('max_seconds', entry['seconds']) if spread else entry['seconds']
+    return {k: v for k, v in metrics.items() if v is not None}
+
+def compare(current: dict, baseline: dict, tolerance: float = 0.25, min_seconds: float = 0.1):
+    """
+    返回回归列表 [(用例, 指标, 基准秒数, 当前秒数)]：当前最小耗时超过基准最小耗时的 (1 + tolerance) 倍，
+    且超出基准重复运行的最大耗时 (噪声范围)；基准低于 min_seconds 的指标不比较。
+    """
+    regressions = []
+    for case_id, case in current['cases'].items():
+        if case_id not in baseline.get('cases', {}): continue
+        old = _metrics(baseline['cases'][case_id]); old_max = _metrics(baseline['cases'][case_id], spread=True)
+        for name, seconds in _metrics(case).items():
+            if name in old and old[name] >= min_seconds and seconds > max(old[name] * (1 + tolerance), old_max.get(name, 0.0)): regressions.append((case_id, name, old[name], seconds))
+    return regressions
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='python benchmarks/bench.py', description='SpatialPalette 生成流程与编辑器操作的性能基准。')
+    parser.add_argument('--scales', nargs='+', choices=list(SCALES), default=['small', 'medium'])
+    parser.add_argument('--coverages', nargs='+', choices=list(COVERAGES), default=list(COVERAGES))
+    parser.add_argument('--repeat', type=int, default=3, help='每个用例重复次数，耗时取最小值，最大值记为噪声范围 (默认 3)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help='不统计各阶段的 tracemalloc 内存峰值')
+    parser.add_argument('--no-editor', dest='editor', action='store_false', help='只测生成流程')
+    parser.add_argument('-o', '--output', default=None, help='结果 JSON 路径')
+    parser.add_argument('--compare', default=None, help='与之前的基准 JSON 比较')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='允许的相对变慢比例 (默认 0.25)')
+    parser.add_argument('--min-seconds', type=float, default=0.1, help='基准耗时低于该值的指标不参与比较 (默认 0.1s，Agg 下的短编辑操作波动较大)')
+    return parser
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    report = {'meta': _metadata(), 'cases': {}}
+    for scale in args.scales:
+        for coverage in args.coverages:
+            case_id = f"{scale}-{coverage}"; print(f"--- {case_id} ---", flush=True)
+            case = _best_of([_run_isolated(scale, coverage, args.seed, args.memory, args.editor) for _ in range(args.repeat)]); report['cases'][case_id] = case
+            stages = ", ".join(f"{name} {entry['seconds']:.3f}s" for name, entry in case['pipeline'].items())
+            print(f"  {case['n_spots']} 个点 | 流程 {case['pipeline_seconds']:.3f}s ({stages}) | 进程内存峰值 {case['peak_rss_mb']} MB")
+            if 'editor' in case: print("  编辑器: " + ", ".join(f"{name} {entry['seconds']:.3f}s" for name, entry in case['editor'].items()))
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f: json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.output}")
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f: baseline = json.load(f)
+        regressions = compare(report, baseline, tolerance=args.tolerance, min_seconds=args.min_seconds)
+        for case_id, name, old, new in regressions: print(f"  回归: {case_id} {name}: {old:.3f}s -> {new:.3f}s ({new / old:.2f}x)")
+        print(f"--- 与 {args.compare} 比较：{len(regressions)} 项超出容差 {args.tolerance:.0%} ---")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
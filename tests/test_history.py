@@ -0,0 +1,36 @@
+# tests/test_history.py
+
+import pickle
+import pandas as pd
+import pytest
+
+from annotator.history import Edit, EditHistory
+
+def _session(journal_path, n_edits, n_undos, **kwargs):
+    df = pd.DataFrame({'barcode': [f'b{i}' for i in range(n_edits)], 'cell_type': pd.Categorical(['Type_0'] * n_edits)})
+    types = ['Type_0', 'Type_1']; history = EditHistory(df, types, journal_path=str(journal_path), **kwargs)
+    for i in range(n_edits): df = history.do(Edit.relabel(df, [i], 'Type_1', types, types), df)
+    for _ in range(n_undos): df, types = history.undo(df)
+    return df, history
+
+def test_replay_keeps_session_history_limits(tmp_path):
+    """日志中的撤销记录超出默认深度时，回放仍应与原会话一致"""
+    journal = tmp_path / 'session.journal'
+    df, history = _session(journal, 25, 22, max_depth=100)
+    replayed, _, restored = EditHistory.replay(str(journal))
+    pd.testing.assert_frame_equal(replayed, df)
+    assert restored.max_depth == 100
+    assert len(restored.undo_stack) == len(history.undo_stack) and len(restored.redo_stack) == len(history.redo_stack)
+
+def test_replay_applies_caller_limits_after_replay(tmp_path):
+    journal = tmp_path / 'session.journal'
+    df, _ = _session(journal, 25, 22, max_depth=100)
+    replayed, _, restored = EditHistory.replay(str(journal), max_depth=2)
+    pd.testing.assert_frame_equal(replayed, df)
+    assert len(restored.undo_stack) == 2 and restored.max_depth == 2
+
+def test_replay_rejects_undo_without_edit(tmp_path):
+    journal = tmp_path / 'session.journal'
+    _session(journal, 1, 1)
+    with open(journal, 'ab') as f: pickle.dump(('undo',), f)
+    with pytest.raises(ValueError, match='已损坏'): EditHistory.replay(str(journal))
@@ -0,0 +1,32 @@
+# tests/test_image_processing.py
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from annotator.image_processing import extract_tile_colors, extract_tile_colors_from_file
+
+tifffile = pytest.importorskip("tifffile")
+
+def test_streaming_reads_tiff_above_pil_pixel_limit(tmp_path, monkeypatch):
+    """流式读取超过 PIL 解压炸弹阈值的 TIFF 时不应经过 PIL 解析尺寸"""
+    grid = 4; tile = 16; side = grid * tile
+    colors = np.random.default_rng(0).integers(0, 256, size=(grid, grid, 3), dtype=np.uint8)
+    pixels = np.repeat(np.repeat(colors, tile, axis=0), tile, axis=1)
+    image_path = tmp_path / "large.tif"
+    tifffile.imwrite(image_path, pixels, photometric='rgb', tile=(tile, tile))
+    # 将阈值压到图像像素数的一半以下，使 PIL 打开该图像时抛出 DecompressionBombError
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", side * side // 4)
+    with pytest.raises(Image.DecompressionBombError): Image.open(image_path)
+    result = extract_tile_colors_from_file(str(image_path), grid, grid)
+    np.testing.assert_array_equal(result, colors)
+
+def test_streaming_falls_back_for_undecodable_compression(tmp_path):
+    """tifffile 无法解码的压缩格式 (未安装 imagecodecs 时的 LZW) 应回退为整图解码，结果与 extract_tile_colors 一致"""
+    grid = 4; tile = 16
+    colors = np.random.default_rng(1).integers(0, 256, size=(grid, grid, 3), dtype=np.uint8)
+    pixels = np.repeat(np.repeat(colors, tile, axis=0), tile, axis=1)
+    image_path = tmp_path / "lzw.tif"
+    Image.fromarray(pixels).save(image_path, compression='tiff_lzw')
+    expected = extract_tile_colors(np.array(Image.open(image_path).convert("RGB")), grid, grid)
+    np.testing.assert_array_equal(extract_tile_colors_from_file(str(image_path), grid, grid), expected)
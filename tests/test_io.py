@@ -0,0 +1,13 @@
+# tests/test_io.py
+
+import numpy as np
+import pandas as pd
+
+from annotator.io import match_barcodes
+
+def test_match_barcodes_uses_placeholder_for_missing_barcode():
+    master = pd.DataFrame({'barcode': ['AAA', np.nan], 'grid_x': [1, 2], 'grid_y': [1, 1]})
+    df = pd.DataFrame({'grid_x': [1, 2, 3], 'grid_y': [1, 1, 1]})
+    barcodes, unmatched = match_barcodes(df, master)
+    assert list(barcodes) == ['AAA', 'spot_1_2', 'spot_1_3']
+    assert list(unmatched) == [False, True, True]
@@ -0,0 +1,12 @@
+# tests/test_profiling.py
+
+from annotator.profiling import Profiler
+
+def test_spawn_copies_configuration_without_records():
+    seen = []; template = Profiler(memory=True, callback=seen.append)
+    with template.stage('warmup'): pass
+    child = template.spawn(memory=False)
+    with child.stage('tile_colors'): pass
+    assert [r['name'] for r in template.records] == ['warmup'] and [r['name'] for r in child.records] == ['tile_colors']
+    assert child.callback is template.callback and not child.memory and 'peak_mb' not in child.records[0]
+    assert [r['name'] for r in seen] == ['warmup', 'tile_colors']